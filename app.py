@@ -11,18 +11,25 @@ from flask import (
     send_file,
     jsonify,
 )
-from flask_sse import sse
+from werkzeug.http import parse_content_range_header
 import dotenv
 
 # import bleach
-import os, shutil, threading, uuid, requests, secrets, string, re, time, unicodedata
+import os, shutil, uuid, requests, secrets, string, re, time, json
 from datetime import timedelta, datetime
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from azure.cosmos import CosmosClient, PartitionKey
 from azure.cosmos.exceptions import CosmosHttpResponseError
 
 import ds2logreader
+import email_store
+import events
+import jobs
+import log_writer
+import mailer
+import metrics
+import output_zip
+import pipeline
+import segment_cache
+import uploads
 
 dotenv.load_dotenv()
 
@@ -35,12 +42,13 @@ EMAIL_PARTITION_KEY = "Email Addresses"
 is_prod = os.getenv("IS_PROD")
 file_root = os.getenv("FILE_ROOT")
 sendgrid_api_key = os.getenv("SENDGRID_API_KEY")
-key_path = PartitionKey(path="/emailId")
 
 UPLOAD_FOLDER = os.path.join("", "uploads")
 ARCHIVE_FOLDER = os.path.join(file_root, "archive")
 OUTPUT_TEMP_FOLDER = os.path.join("", "output_temp")
 FINAL_FOLDER = os.path.join(file_root, "final")
+CACHE_FOLDER = os.path.join(file_root, "cache")
+MAIL_FOLDER = os.path.join(file_root, "mail")
 
 SYS_LOG_FOLDER = os.path.join(file_root, "logs")
 
@@ -54,22 +62,117 @@ assert app.secret_key is not None
 app.config["REDIS_URL"] = os.getenv("REDIS_URL")
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(hours=4)
 
-app.register_blueprint(sse, url_prefix="/stream")
-
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["ARCHIVE_FOLDER"] = ARCHIVE_FOLDER
 app.config["OUTPUT_TEMP_FOLDER"] = OUTPUT_TEMP_FOLDER
 app.config["FINAL_FOLDER"] = FINAL_FOLDER
+app.config["CACHE_FOLDER"] = CACHE_FOLDER
+# Whole requests past this are refused before Werkzeug spools them
+app.config["MAX_CONTENT_LENGTH"] = uploads.MAX_TOTAL_SIZE + 1024 * 1024
 app.config["RECAPTCHA_SECRET_KEY"] = os.getenv("RC_SECRET_KEY_V2")
+# Worker processes per batch, defaults to one per core
+app.config["PROCESS_WORKERS"] = int(
+    os.getenv("PROCESS_WORKERS", os.cpu_count() or 1)
+)
+# Batches run at once per web worker, and queued or running across all
+app.config["JOB_WORKERS"] = int(os.getenv("JOB_WORKERS", jobs.JOB_WORKERS))
+app.config["JOB_QUEUE_SIZE"] = int(
+    os.getenv("JOB_QUEUE_SIZE", jobs.JOB_QUEUE_SIZE)
+)
+
+# Optional json list of extra log layouts, see ds2logreader.LOG_FORMATS
+app.config["LOG_FORMATS_FILE"] = os.getenv("LOG_FORMATS_FILE")
+log_formats = (
+    ds2logreader.load_log_formats(app.config["LOG_FORMATS_FILE"])
+    if app.config["LOG_FORMATS_FILE"]
+    else None
+)
+
+# Sets found in each log, reused when the same log is processed again
+app.config["CACHE_SIZE"] = int(
+    os.getenv("CACHE_SIZE", segment_cache.CACHE_SIZE)
+)
+cache = segment_cache.SegmentCache(
+    app.config["CACHE_FOLDER"], max_size=app.config["CACHE_SIZE"]
+)
+
+# JSON line logs under SYS_LOG_FOLDER, rotated by size
+app.config["LOG_MAX_BYTES"] = int(
+    os.getenv("LOG_MAX_BYTES", log_writer.MAX_BYTES)
+)
+logger = log_writer.LogWriter(
+    SYS_LOG_FOLDER, max_bytes=app.config["LOG_MAX_BYTES"]
+)
+
+# Email records, kept in memory instead when there is no Cosmos endpoint
+app.config["EMAIL_CACHE_TTL"] = float(
+    os.getenv("EMAIL_CACHE_TTL", email_store.CACHE_TTL)
+)
+emails = email_store.EmailStore(
+    CDB_ENDPOINT,
+    CDB_KEY,
+    CDB_NAME,
+    CDB_CONTAINER_NAME,
+    "emailId",
+    EMAIL_PARTITION_KEY,
+    ttl=app.config["EMAIL_CACHE_TTL"],
+)
+
+# Emails are sent from a background thread, through SendGrid or written
+# to MAIL_FOLDER when EMAIL_TRANSPORT is "file" or there is no API key
+app.config["EMAIL_TRANSPORT"] = os.getenv(
+    "EMAIL_TRANSPORT", "sendgrid" if sendgrid_api_key else "file"
+)
+app.config["EMAIL_RETRIES"] = int(os.getenv("EMAIL_RETRIES", mailer.RETRIES))
+if app.config["EMAIL_TRANSPORT"] == "sendgrid":
+    email_transport = mailer.SendGridTransport(sendgrid_api_key)
+else:
+    email_transport = mailer.FileTransport(MAIL_FOLDER)
+outbox = mailer.Mailer(
+    email_transport, retries=app.config["EMAIL_RETRIES"], log=logger.log
+)
+
+# With PIPELINE_UPLOADS each log is processed as it lands, with the
+# settings sent along with it, and /process collects the outputs of those
+# whose settings are unchanged. Otherwise the pipeline's workers index each
+# log as it lands, so previews and processing of it read the cached index
+app.config["PIPELINE_UPLOADS"] = os.getenv("PIPELINE_UPLOADS", "") in (
+    "1",
+    "true",
+)
+app.config["PIPELINE_WORKERS"] = int(
+    os.getenv("PIPELINE_WORKERS", pipeline.PIPELINE_WORKERS)
+)
+upload_pipeline = pipeline.UploadPipeline(
+    os.path.join(OUTPUT_TEMP_FOLDER, ".pipeline"),
+    app.config["PERMANENT_SESSION_LIFETIME"].total_seconds(),
+    workers=app.config["PIPELINE_WORKERS"],
+    log_formats=log_formats,
+    cache=cache,
+    chunk_workers=app.config["PROCESS_WORKERS"],
+)
 
+# Stage timings and totals of every batch run by this process
+metrics_registry = metrics.Metrics()
 
-def sys_log(msg, filename="std_out.log"):
-    current_datetime = datetime.now()
-    formatted_datetime = current_datetime.strftime("%Y/%m/%d %H:%M:%S")
-    full_path = os.path.join(SYS_LOG_FOLDER, filename)
+# Progress of each batch, on a channel of its own that clients can resume
+event_channels = events.EventChannels(
+    app.config["PERMANENT_SESSION_LIFETIME"].total_seconds(),
+    redis_url=app.config["REDIS_URL"],
+)
 
-    with open(full_path, "a") as file:
-        file.write(f"{formatted_datetime} - {msg}\n")
+job_queue = jobs.JobQueue(
+    app.config["PERMANENT_SESSION_LIFETIME"].total_seconds(),
+    workers=app.config["JOB_WORKERS"],
+    queue_size=app.config["JOB_QUEUE_SIZE"],
+    redis_url=app.config["REDIS_URL"],
+    log=logger.log,
+)
+
+
+def sys_log(msg, filename="std_out.log", **fields):
+    # queued for the writer thread, requests never wait on the file
+    logger.log(msg, filename, **fields)
 
 
 def is_valid_email(email):
@@ -84,14 +187,16 @@ def generate_random_key(length=32):
     return "".join(secrets.choice(characters) for _ in range(length))
 
 
-def get_cdb_container():
-    client = CosmosClient(CDB_ENDPOINT, CDB_KEY)
+def read_email_item(email_address, token=None):
+    item = emails.read(email_address)
 
-    database = client.create_database_if_not_exists(id=CDB_NAME)
+    # a record cached before another worker changed it is read again
+    # rather than turning the request away
+    bad_secret = token is not None and item["secret"] != token
+    if bad_secret or not item["is_verified"]:
+        item = emails.read(email_address, fresh=True)
 
-    return database.create_container_if_not_exists(
-        id=CDB_CONTAINER_NAME, partition_key=key_path
-    )
+    return item
 
 
 def send_email(
@@ -100,29 +205,8 @@ def send_email(
     # Was causing & to become &amp; breaking Flask routing
     # content = bleach.clean(content)
 
-    # Prepare the email
-    message = Mail(
-        from_email=from_email,
-        to_emails=to_email,
-        subject=subject,
-        plain_text_content=content,
-    )
-
-    try:
-        sg = SendGridAPIClient(sendgrid_api_key)
-        response = sg.send(message)
-        sys_log(f"Sent email to {to_email}")
-        return jsonify({"message": "Email sent successfully"}), 200
-    except Exception as e:
-        return (
-            jsonify(
-                {
-                    "message": "An error occurred while sending the email",
-                    "error": str(e),
-                }
-            ),
-            500,
-        )
+    # queued, failures are retried and logged by the mailer thread
+    outbox.send(to_email, subject, content, from_email)
 
 
 @app.route("/feedback", methods=["POST"])
@@ -186,72 +270,122 @@ def index():
             return "reCaptcha no verified", 401
 
         session_id = session["session_id"]
+        upload_dir = create_session_folders(session_id)
 
-        # Create a new directory to store this user's files
-        upload_dir = os.path.join(app.config["UPLOAD_FOLDER"], session_id)
-        os.makedirs(upload_dir, exist_ok=True)
-
-        # Similar for the output temp directory
-        output_temp_dir = os.path.join(
-            app.config["OUTPUT_TEMP_FOLDER"], session_id
-        )
-        os.makedirs(output_temp_dir, exist_ok=True)
-
-        # Similar for the archive directory
-        archive_dir = os.path.join(app.config["ARCHIVE_FOLDER"], session_id)
-        os.makedirs(archive_dir, exist_ok=True)
-
-        # Similar for the final directory
-        final_dir = os.path.join(app.config["FINAL_FOLDER"], session_id)
-        os.makedirs(final_dir, exist_ok=True)
-
-        # Define a regular expression pattern to match unsafe characters
-        unsafe_chars_pattern = re.compile(r'[\\/:*?"<>|]')
-
+        upload_start = time.perf_counter()
         total_file_size = 0
         for file in request.files.getlist("file"):
-            original_filename = file.filename
-            # Move the file cursor to the end to get the file size
+            filename = uploads.sanitize_filename(file.filename)
+            # Werkzeug has spooled the file already, the chunked upload
+            # route is the one that checks limits as the bytes arrive
             file.seek(0, os.SEEK_END)
             file_size = file.tell()
-            total_file_size += file_size
-
-            # Reset the file cursor back to the beginning for saving the file
             file.seek(0)
 
-            if total_file_size > 524288000:
-                print(
-                    f"ERROR: User attempted to upload {total_file_size} total bytes"
+            try:
+                uploads.write_chunk(
+                    upload_dir, filename, file.stream, 0, file_size
                 )
-                return "Total files size too large", 401
-
-            if file_size > 157286400:
-                print(f"ERROR: User tried to download {file_size} bytes")
-                return "Files size too large", 401
+            except uploads.UploadRejected as e:
+                sys_log(f"{session_id} upload rejected: {e}", "errors.log")
+                return str(e), 401
 
-            # Normalize the filename
-            normalized_filename = (
-                unicodedata.normalize("NFKD", original_filename)
-                .encode("ascii", "ignore")
-                .decode("utf-8")
-            )
-            # Remove unsafe characters from the filename
-            sanitized_filename = re.sub(
-                unsafe_chars_pattern, "", normalized_filename
+            total_file_size += file_size
+            upload_complete(
+                session_id,
+                os.path.join(upload_dir, filename),
+                request.form.get("settings"),
             )
-            # Limit the filename length if needed
-            sanitized_filename = sanitized_filename[
-                :255
-            ]  # Example: Limit to 255 characters
 
-            # Save the file with the sanitized filename
-            file.save(os.path.join(upload_dir, sanitized_filename))
+        metrics_registry.observe(
+            "stage_seconds",
+            time.perf_counter() - upload_start,
+            stage="upload",
+        )
+        metrics_registry.inc("bytes_uploaded_total", total_file_size)
 
         return redirect(url_for("index"))
 
     return render_template("index.html")
 
 
+def create_session_folders(session_id):
+    # Upload, output temp, archive and final folders of a session, returns
+    # the upload folder
+    for folder in ("OUTPUT_TEMP_FOLDER", "ARCHIVE_FOLDER", "FINAL_FOLDER"):
+        os.makedirs(
+            os.path.join(app.config[folder], session_id), exist_ok=True
+        )
+
+    upload_dir = os.path.join(app.config["UPLOAD_FOLDER"], session_id)
+    os.makedirs(upload_dir, exist_ok=True)
+    return upload_dir
+
+
+def upload_complete(session_id, filepath, settings):
+    # settings is the json the client would send to /process now
+    if app.config["PIPELINE_UPLOADS"] and settings:
+        try:
+            upload_pipeline.submit(session_id, filepath, json.loads(settings))
+            return
+        except (ValueError, AttributeError) as e:
+            sys_log(f"{session_id} bad upload settings: {e}", "errors.log")
+
+    upload_pipeline.warm(filepath)
+
+
+@app.route("/upload/<filename>", methods=["GET", "PUT"])
+def upload_chunk(filename):
+    # Resumable uploads, each PUT carries one chunk of the file with a
+    # Content-Range header and GET says how much of it is on disk
+    if "valid" not in session or "session_id" not in session:
+        return "reCaptcha no verified", 401
+
+    session_id = session["session_id"]
+    filename = uploads.sanitize_filename(filename)
+    upload_dir = create_session_folders(session_id)
+
+    if request.method == "GET":
+        size, complete = uploads.received(upload_dir, filename)
+        return jsonify({"received": size, "complete": complete})
+
+    content_range = parse_content_range_header(
+        request.headers.get("Content-Range")
+    )
+    if content_range is None or content_range.length is None:
+        return "Content-Range required", 400
+
+    upload_start = time.perf_counter()
+    try:
+        size, complete = uploads.write_chunk(
+            upload_dir,
+            filename,
+            request.stream,
+            content_range.start or 0,
+            content_range.length,
+        )
+    except uploads.UploadRejected as e:
+        sys_log(f"{session_id} upload rejected: {e}", "errors.log")
+        size, complete = uploads.received(upload_dir, filename)
+        return jsonify({"message": str(e), "received": size}), e.status
+
+    metrics_registry.observe(
+        "stage_seconds", time.perf_counter() - upload_start, stage="upload"
+    )
+    metrics_registry.inc(
+        "bytes_uploaded_total", size - (content_range.start or 0)
+    )
+
+    if complete:
+        upload_complete(
+            session_id,
+            os.path.join(upload_dir, filename),
+            request.headers.get("X-Settings"),
+        )
+
+    return jsonify({"received": size, "complete": complete})
+
+
 def process_files_background(session_id, out_id, settings):
     with app.app_context():
         output_dir = os.path.join(app.config["OUTPUT_TEMP_FOLDER"], session_id)
@@ -266,65 +400,187 @@ def process_files_background(session_id, out_id, settings):
             pedal_threshold=settings["pedal_threshold"],
             mid_pedal_for_wot=settings["min_pedal_for_wot"],
             group_wot=group_wot,
+            engine=settings.get("engine"),
+            streaming=settings.get("streaming"),
+            log_formats=log_formats,
+            cache=cache,
+            output_format=settings.get("output_format"),
+            filtered_headers=settings.get("columns"),
+            chunk_workers=app.config["PROCESS_WORKERS"],
+            combine_batch=settings.get("combine_batch"),
         )
 
-        try:
-            for filename in os.listdir(upload_dir):
-                if filename[0] == ".":
-                    continue
-
-                file_path = os.path.join(upload_dir, filename)
-                before_files = ds2logreader.get_unique_files(output_dir)
-                result = ds2.process_file(file_path)
-                after_files = ds2logreader.get_unique_files(output_dir)
-                output_files = list(after_files - before_files)
-
-                if result != "":
-                    print(f"Error processing {filename}: {result}")
-                    sse.publish(
-                        {"message": f"Error processing {filename}: {result}"},
-                        type="process_update",
-                    )
-                    continue
+        job_metrics = metrics.JobMetrics()
+        channel = job_channel(session_id, out_id)
+
+        # outputs are zipped as each log finishes rather than after the batch
+        zip_output = output_zip.OutputZip(
+            f"{final_dir}/output_{out_id}.zip", output_dir
+        )
+
+        def file_complete(result):
+            filename = os.path.basename(result.input_file)
+            job_metrics.add_result(result)
+
+            if result.error != "":
+                sys_log(
+                    f"{session_id} error processing {filename}: {result.error}",
+                    "errors.log",
+                )
+                event_channels.publish(
+                    channel,
+                    {
+                        "message": f"Error processing {filename}: {result.error}"
+                    },
+                )
+                return
 
+            with job_metrics.stage("archive"):
                 shutil.move(
-                    file_path,
+                    result.input_file,
                     os.path.join(archive_dir, filename),
                 )
 
-                sse.publish(
-                    {
-                        "message": f"Processing complete for {filename}",
-                        "outputFiles": output_files,
-                        "inputFile": filename,
-                        "status": "fileComplete",
-                    },
-                    type="process_update",
+            with job_metrics.stage("zip"):
+                for output_filename in result.output_files:
+                    zip_output.add(output_filename)
+
+            progress.add(
+                filename,
+                [os.path.relpath(f, output_dir) for f in result.output_files],
+                result.rows_written,
+                result.bytes_read,
+            )
+
+        def file_progress(filepath, rows, bytes_read):
+            progress.update(
+                os.path.basename(filepath),
+                rows,
+                bytes_read,
+                os.path.getsize(filepath),
+            )
+
+        try:
+            file_paths = [
+                os.path.join(upload_dir, filename)
+                for filename in os.listdir(upload_dir)
+                if filename[0] != "."
+            ]
+            progress = events.Progress(
+                event_channels,
+                channel,
+                len(file_paths),
+                sum(os.path.getsize(path) for path in file_paths),
+            )
+
+            if app.config["PIPELINE_UPLOADS"]:
+                file_paths = collect_prepared(
+                    ds2, session_id, file_paths, settings, file_complete
                 )
 
-            # If empty dir, then no wot runs
-            files_processed = ds2logreader.get_unique_files(output_dir)
-            files_processed = len(files_processed)
-            if files_processed == 0:
-                sse.publish(
+            # don't index a log in the pipeline while it is being processed
+            upload_pipeline.settle(file_paths)
+            ds2.process_files(
+                file_paths,
+                max_workers=app.config["PROCESS_WORKERS"],
+                on_complete=file_complete,
+                on_progress=file_progress,
+            )
+
+            # runs of every log were added to it as each one finished
+            batch_result = ds2.finish_batch()
+            if batch_result is not None:
+                for stage, seconds in batch_result.timings.items():
+                    job_metrics.add_stage(stage, seconds)
+                with job_metrics.stage("zip"):
+                    for output_filename in batch_result.output_files:
+                        zip_output.add(output_filename)
+
+            progress.flush()
+
+            # If nothing was written, then no wot runs
+            with job_metrics.stage("zip"):
+                written = zip_output.close()
+            if not written:
+                event_channels.publish(
+                    channel,
                     {"message": "No wot runs found", "status": "empty"},
-                    type="process_update",
                 )
                 return out_id
 
-            shutil.make_archive(
-                f"{final_dir}/output_{out_id}", "zip", output_dir
-            )
-
-            sse.publish(
-                {"message": "Processing complete", "status": "complete"},
-                type="process_update",
+            event_channels.publish(
+                channel,
+                {
+                    "message": "Processing complete",
+                    "status": "complete",
+                    "metrics": job_metrics.summary(),
+                },
             )
 
             return out_id
         except Exception as e:
-            print(f"Exception: {type(e)}\n{e.args}")
-            sse.publish({"message": str(e)}, type="process_update")
+            ds2.discard_batch()
+            zip_output.discard()
+            sys_log(
+                f"{session_id} processing failed: {type(e)} {e.args}",
+                "errors.log",
+            )
+            event_channels.publish(
+                channel, {"message": str(e), "status": "failed"}
+            )
+        finally:
+            metrics_registry.record_job(job_metrics)
+
+
+def job_channel(session_id, out_id):
+    return f"{session_id}:{out_id}"
+
+
+@app.route("/stream", methods=["GET"])
+def stream_events():
+    # Events of the session's latest batch. Browsers send Last-Event-ID when
+    # they reconnect, and are sent only the events after it
+    if "session_id" not in session or "out_id" not in session:
+        abort(404)
+
+    try:
+        last_id = int(request.headers.get("Last-Event-ID", 0))
+    except ValueError:
+        last_id = 0
+
+    return Response(
+        event_channels.stream(
+            job_channel(session["session_id"], session["out_id"]), last_id
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def collect_prepared(ds2, session_id, file_paths, settings, on_complete):
+    # Outputs of logs already processed with these settings are moved into
+    # the batch, returns the logs still to process
+    ds2.batch_start_time = datetime.now()
+    error = ds2.create_output_folders()
+    if error:
+        return file_paths
+
+    remaining = []
+    for filepath in file_paths:
+        result = upload_pipeline.take(
+            session_id, filepath, settings, ds2.output_path
+        )
+        if result is None:
+            remaining.append(filepath)
+            continue
+
+        for output_filename in result.output_files:
+            ds2.add_output(output_filename)
+        ds2.add_to_batch(result)
+        metrics_registry.inc("pipeline_files_total")
+        on_complete(result)
+
+    return remaining
 
 
 @app.route("/process", methods=["POST"])
@@ -333,18 +589,65 @@ def process_files():
     out_id = str(int(time.time()))
     session["out_id"] = out_id
     settings = request.get_json()["settings"]
-    if is_prod:
-        process_files_background(session_id, out_id, settings)
-    else:
-        threading.Thread(
-            target=process_files_background,
-            args=(
-                session_id,
-                out_id,
-                settings,
-            ),
-        ).start()
-    return Response("Processing started.", 202)
+
+    try:
+        job_id = job_queue.submit(
+            process_files_background,
+            session_id,
+            out_id,
+            settings,
+            owner=session_id,
+        )
+    except jobs.QueueFull as e:
+        sys_log(f"{session_id} process rejected: {e}", "errors.log")
+        return Response("Server busy, please try again shortly.", 429)
+
+    session["job_id"] = job_id
+    return jsonify({"message": "Processing started.", "jobId": job_id}), 202
+
+
+@app.route("/preview", methods=["POST"])
+def preview_files():
+    # Sets each upload would give at every requested setting, read from
+    # the cached pedal index so the settings dialog can update as it moves.
+    # Logs still being indexed give null rather than being indexed here
+    session_id = session["session_id"]
+    upload_dir = os.path.join(app.config["UPLOAD_FOLDER"], session_id)
+    settings = [
+        (s.get("pedal_threshold"), s.get("min_pedal_for_wot"))
+        for s in request.get_json()["settings"]
+    ]
+
+    ds2 = ds2logreader.DS2LogReader(log_formats=log_formats, cache=cache)
+
+    previews = {}
+    if os.path.isdir(upload_dir):
+        for filename in os.listdir(upload_dir):
+            if filename[0] == ".":
+                continue
+            previews[filename] = ds2.preview(
+                os.path.join(upload_dir, filename), settings, cached_only=True
+            )
+
+    return jsonify({"files": previews})
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = job_queue.status(job_id)
+
+    if not job or job["owner"] != session.get("session_id"):
+        abort(404)
+
+    del job["owner"]
+    return jsonify(job)
+
+
+@app.route("/metrics", methods=["GET"])
+def export_metrics():
+    return Response(
+        metrics_registry.render(), mimetype="text/plain; version=0.0.4"
+    )
 
 
 @app.route("/download", methods=["GET"])
@@ -369,11 +672,7 @@ def download_page():
     token = request.args.get("token")
 
     if email_address and token:
-        container = get_cdb_container()
-
-        item = container.read_item(
-            item=email_address, partition_key=EMAIL_PARTITION_KEY
-        )
+        item = read_email_item(email_address, token)
 
         if item["secret"] != token:
             sys_log(f"{email_address} bad secret", "errors.log")
@@ -399,11 +698,7 @@ def retrieve_file():
     token = request.args.get("token")
 
     if email_address and token:
-        container = get_cdb_container()
-
-        item = container.read_item(
-            item=email_address, partition_key=EMAIL_PARTITION_KEY
-        )
+        item = read_email_item(email_address, token)
 
         if item["secret"] != token:
             return "Bad secret", 400
@@ -413,7 +708,7 @@ def retrieve_file():
 
         item["send_count"] += 1
 
-        container.upsert_item(item)
+        emails.upsert(item)
 
         try:
             sys_log(
@@ -471,17 +766,13 @@ def email_user():
     if not is_valid_email(email_address):
         return "Email is of an unexpected form", 400
 
-    container = get_cdb_container()
-
     token = generate_random_key()
 
     try:
         out_id = session.get("out_id")
         assert out_id
 
-        item = container.read_item(
-            item=email_address, partition_key=EMAIL_PARTITION_KEY
-        )
+        item = read_email_item(email_address)
 
         if not item["is_verified"]:
             sys_log(f"{email_address} is not verified", "errors.log")
@@ -496,7 +787,7 @@ def email_user():
 
         item["download_link"] = final_dir
 
-        container.upsert_item(item)
+        emails.upsert(item)
 
         download_url = url_for(
             "download_page",
@@ -529,7 +820,7 @@ def email_user():
             "download_link": final_dir,
         }
 
-        container.create_item(new_item)
+        emails.create(new_item)
 
         validation_url = url_for(
             "validate_email",
@@ -558,11 +849,8 @@ def validate_email():
     token = request.args.get("token")
 
     if email_address and token:
-        container = get_cdb_container()
-
-        item = container.read_item(
-            item=email_address, partition_key=EMAIL_PARTITION_KEY
-        )
+        # verifying is a one time change, so never from a cached record
+        item = emails.read(email_address, fresh=True)
 
         if item["secret"] != token:
             return "Bad secret", 400
@@ -574,7 +862,7 @@ def validate_email():
         item["is_verified"] = True
         item["send_count"] += 1
 
-        container.upsert_item(item)
+        emails.upsert(item)
 
         download_url = url_for(
             "download_page",
@@ -0,0 +1,274 @@
+"""Times DS2LogReader on synthetic logs.
+
+    python benchmarks/bench.py --rows 200000 --columns 90 --compare
+
+Each case runs in a fresh process so its peak RSS is its own, and rates are
+over the rows and bytes of the input logs. Results are
+appended to benchmarks/results.jsonl with the commit they were run on, and
+--compare shows the change from the last run of the same case on another
+commit.
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ds2logreader
+from benchmarks import synth
+
+RESULTS_FILE = os.path.join(ROOT, "benchmarks", "results.jsonl")
+CASES = ["process_file", "write_as_individuals", "write_as_one", "pipeline"]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(usage, children) / scale, 1)
+
+
+def make_logs(folder, args):
+    paths = []
+    for i in range(args.files):
+        path = os.path.join(folder, synth.log_filename(args.layout, i))
+        synth.generate_log(
+            path,
+            args.rows,
+            pulls=args.pulls,
+            extra_columns=args.columns,
+            layout=args.layout,
+            seed=i,
+        )
+        paths.append(path)
+
+    return paths
+
+
+def read_sets(ds2, path):
+    # the sets read_file would write, without writing them
+    with open(path, "r") as file:
+        reader = csv.reader(file)
+        title = next(reader)
+        headers = next(reader)
+        log_format, columns = ds2.resolve_columns(headers)
+        in_datetime = datetime.fromtimestamp(os.path.getmtime(path))
+        filtered_sets = ds2.segment_file(
+            path, file.encoding, reader, in_datetime, columns
+        )
+
+    return title, headers, headers[columns["time"]], filtered_sets or []
+
+
+def run_case(case, paths, output_folder, settings):
+    ds2 = ds2logreader.DS2LogReader(output_folder=output_folder, **settings)
+    ds2.batch_start_time = datetime.now()
+    ds2.create_output_folders()
+
+    if case == "process_file":
+        start = time.perf_counter()
+        for path in paths:
+            ds2.process_file(path)
+        return time.perf_counter() - start
+
+    if case == "pipeline":
+        return run_pipeline(paths, output_folder, settings)
+
+    elapsed = 0.0
+    for path in paths:
+        title, headers, time_header, filtered_sets = read_sets(ds2, path)
+        header_indices = list(range(len(headers)))
+        start = time.perf_counter()
+        if case == "write_as_individuals":
+            ds2.write_as_individuals(
+                title, headers, filtered_sets, header_indices
+            )
+        else:
+            ds2.write_as_one(
+                title, headers, filtered_sets, header_indices, time_header
+            )
+        elapsed += time.perf_counter() - start
+
+    return elapsed
+
+
+def run_pipeline(paths, output_folder, settings):
+    # process_files_background needs the app's folders, and its events are
+    # kept in memory instead of going through Redis
+    os.environ["FILE_ROOT"] = os.path.join(output_folder, "root")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.pop("REDIS_URL", None)
+    os.makedirs(os.path.join(os.environ["FILE_ROOT"], "logs"), exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(output_folder)
+    try:
+        import app
+
+        session_id = "benchmark"
+        for folder in (
+            app.app.config["UPLOAD_FOLDER"],
+            app.app.config["OUTPUT_TEMP_FOLDER"],
+            app.app.config["ARCHIVE_FOLDER"],
+            app.app.config["FINAL_FOLDER"],
+        ):
+            os.makedirs(os.path.join(folder, session_id), exist_ok=True)
+        upload_dir = os.path.join(app.app.config["UPLOAD_FOLDER"], session_id)
+        for path in paths:
+            shutil.copy(path, upload_dir)
+
+        job_settings = {
+            "pedal_threshold": None,
+            "min_pedal_for_wot": None,
+            "group_wot": False,
+        }
+        job_settings.update(settings)
+        start = time.perf_counter()
+        app.process_files_background(session_id, "benchmark", job_settings)
+        return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+
+def case_worker(case, paths, settings, queue):
+    output_folder = tempfile.mkdtemp(prefix="ds2lv_bench_")
+    try:
+        seconds = run_case(case, paths, output_folder, settings)
+        queue.put((seconds, peak_rss_mb()))
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+
+def measure(case, paths, settings):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(
+        target=case_worker, args=(case, paths, settings, queue)
+    )
+    process.start()
+    seconds, rss = queue.get()
+    process.join()
+
+    return seconds, rss
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_result(results_file, record):
+    # last run of the same case and parameters on another commit
+    if not os.path.exists(results_file):
+        return None
+
+    previous = None
+    with open(results_file, "r") as file:
+        for line in file:
+            result = json.loads(line)
+            if result["commit"] != record["commit"] and all(
+                result.get(key) == record[key]
+                for key in ("case", "params", "settings")
+            ):
+                previous = result
+
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--pulls", type=int, default=10)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--layout", choices=["DS2", "DS1"], default="DS2")
+    parser.add_argument("--engine", action="append", default=None)
+    parser.add_argument("--group-wot", action="store_true")
+    parser.add_argument("--chunk-workers", type=int, default=None)
+    parser.add_argument("--case", action="append", choices=CASES)
+    parser.add_argument("--results", default=RESULTS_FILE)
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    args = parser.parse_args()
+
+    log_folder = tempfile.mkdtemp(prefix="ds2lv_logs_")
+    try:
+        paths = make_logs(log_folder, args)
+        total_rows = args.rows * args.files
+        total_mb = sum(os.path.getsize(path) for path in paths) / 1e6
+        params = {
+            "rows": args.rows,
+            "files": args.files,
+            "pulls": args.pulls,
+            "columns": args.columns,
+            "layout": args.layout,
+        }
+        commit = git_commit()
+
+        print(f"{total_rows} rows, {total_mb:.1f} MB in {args.files} logs")
+        for engine in args.engine or [ds2logreader.ENGINE]:
+            settings = {"engine": engine, "group_wot": args.group_wot}
+            if args.chunk_workers:
+                settings["chunk_workers"] = args.chunk_workers
+            for case in args.case or CASES:
+                seconds, rss = measure(case, paths, settings)
+                record = {
+                    "commit": commit,
+                    "date": datetime.now().isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "case": case,
+                    "params": params,
+                    "settings": settings,
+                    "seconds": round(seconds, 4),
+                    "rows_per_sec": round(total_rows / seconds),
+                    "mb_per_sec": round(total_mb / seconds, 2),
+                    "peak_rss_mb": rss,
+                }
+
+                line = (
+                    f"{engine:>8} {case:<21} {seconds:8.3f}s "
+                    f"{record['rows_per_sec']:>10} rows/s "
+                    f"{record['mb_per_sec']:>8} MB/s {rss} MB peak"
+                )
+                if args.compare:
+                    previous = previous_result(args.results, record)
+                    if previous:
+                        change = seconds / previous["seconds"] - 1
+                        line += f"  {change:+.1%} vs {previous['commit']}"
+                print(line)
+
+                if not args.no_save:
+                    with open(args.results, "a") as file:
+                        file.write(json.dumps(record) + "\n")
+    finally:
+        shutil.rmtree(log_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
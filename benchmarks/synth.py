@@ -0,0 +1,128 @@
+import os
+import random
+from datetime import datetime, timedelta
+
+# headers of the channels sets are found from, in the order they are logged
+DS2_COLUMNS = [
+    "Time(s)",
+    "Eng spd(nmot_w)(1/min)",
+    "Pedal(wped_w)(% PED)",
+    "Gear(gangi)()",
+    "Map switch(mapswitch)(raw)",
+    "Ethanol cont(ethanolpercent)(%)",
+]
+DS1_COLUMNS = [
+    "Time(s)",
+    "RPM(1/min)",
+    "Pedal(%)",
+    "Gear(-)",
+    "Map switch(-)",
+    "Ethanol(%)",
+]
+
+# rows are logged at 20Hz
+ROW_TIME = 0.05
+
+
+def generate_log(
+    path,
+    rows,
+    pulls=10,
+    extra_columns=0,
+    layout="DS2",
+    map_every=40,
+    eth_every=200,
+    kickdown=0.3,
+    seed=0,
+):
+    """Write a synthetic log of rows lines with pulls WOT runs spread across
+    it, and return its size in bytes.
+
+    Map and ethanol are only logged every map_every and eth_every rows, and
+    kickdown is the chance a pull starts a gear below where it cruised.
+    """
+    rng = random.Random(seed)
+    headers = DS2_COLUMNS if layout == "DS2" else DS1_COLUMNS
+    headers = headers + [
+        f"Channel {i}(ch{i})(raw)" for i in range(extra_columns)
+    ]
+
+    # each pull is 4 to 12 seconds at full pedal, centred in its own slot
+    slot = rows // pulls if pulls else rows + 1
+    pull_rows = {}
+    for pull in range(pulls):
+        length = min(rng.randint(80, 240), slot // 2)
+        start = pull * slot + (slot - length) // 2
+        pull_rows[start] = length
+
+    with open(path, "w", newline="") as file:
+        file.write(f"{layout} log,synthetic\n")
+        file.write(",".join(headers) + "\n")
+
+        lines = []
+        gear = 3
+        rpm = 2500.0
+        pull_end = -1
+        for row in range(rows):
+            if row in pull_rows:
+                pull_end = row + pull_rows[row]
+                # the cruising gear is logged, then the kickdown below it
+                gear_field = str(gear)
+                if rng.random() < kickdown and gear > 1:
+                    gear -= 1
+            elif row < pull_end:
+                # shift up at the limiter
+                rpm += 40.0
+                if rpm > 7000.0 and gear < 6:
+                    gear += 1
+                    rpm = 4500.0
+                gear_field = str(gear) if row % 4 == 0 else ""
+            else:
+                rpm = 2500.0 + rng.uniform(-300.0, 300.0)
+                if row % 400 == 0:
+                    gear = rng.randint(2, 4)
+                gear_field = str(gear) if row % 20 == 0 else ""
+
+            if row < pull_end:
+                pedal = 100.0 if rng.random() > 0.02 else 97.5
+            else:
+                pedal = round(rng.uniform(0.0, 60.0), 1)
+
+            map_field = (
+                f"{rng.randint(0, 4)}.0" if row % map_every == 0 else ""
+            )
+            eth_field = (
+                f"{rng.uniform(10.0, 85.0):.1f}"
+                if row % eth_every == 0
+                else ""
+            )
+
+            fields = [
+                f"{row * ROW_TIME:.3f}",
+                f"{rpm:.0f}",
+                f"{pedal}",
+                gear_field,
+                map_field,
+                eth_field,
+            ]
+            fields.extend(
+                f"{rng.random() * 100:.2f}" for i in range(extra_columns)
+            )
+            lines.append(",".join(fields))
+
+            if len(lines) == 10000:
+                file.write("\n".join(lines) + "\n")
+                lines = []
+        if lines:
+            file.write("\n".join(lines) + "\n")
+
+    return os.path.getsize(path)
+
+
+def log_filename(layout="DS2", index=0):
+    # DS2 logs carry their start time in the name, DS1 logs use the mtime
+    if layout == "DS2":
+        start = datetime(2023, 5, 1, 10) + timedelta(minutes=30 * index)
+        return start.strftime("%Y-%m-%d_%H.%M.%S") + "_log.csv"
+
+    return f"ds1_{index:02d}.csv"
@@ -1,7 +1,30 @@
+import copy
 import csv
+import gzip
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
 import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 INPUT_DATE_FORMAT = "%Y-%m-%d_%H.%M.%S"
 OUTPUT_DATE_FORMAT = "%Y-%m-%d_%H.%M.%S"
 OUTPUT_PATH_DATE_FORMAT = "%Y%m%d_%H%M%S"
@@ -10,9 +33,96 @@ MIN_PEDAL_FOR_WOT = 99.0
 OUTPUT_FOLDER = "output_temp"
 OUTPUT_PREFIX = "BATCH_"
 GROUP_WOT = False
+# "rows" walks the csv one line at a time, "columnar" needs numpy and
+# "bytes" scans the raw lines, only decoding the columns it inspects
+ENGINE = "rows"
+# spool each set to disk as it is read instead of holding the whole log
+STREAMING = False
+# extension of each output format, feather and parquet need pyarrow
+OUTPUT_FORMATS = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "feather": ".feather",
+    "parquet": ".parquet",
+}
+OUTPUT_FORMAT = "csv"
+# rows feather and parquet output convert and write at a time
+TABLE_BATCH_ROWS = 10000
+# rows of a spooled set read back into memory at a time
+SPOOL_CHUNK_ROWS = 1000
+# one combined output for the whole batch as well, None for none. Runs are
+# in the order their logs finish with "arrival", or grouped by gears then
+# ethanol with "gear" and by ethanol then gears with "eth"
+COMBINE_BATCH = None
+COMBINE_ORDERS = ("arrival", "gear", "eth")
+BATCH_OUTPUT = "batch_combined"
+# worker processes a log's pedal index is built across, and the smallest
+# chunk of a log worth starting a worker for
+CHUNK_WORKERS = 1
+CHUNK_SIZE = 32 * 1024 * 1024
+# batches with fewer bytes of logs than this are processed one log after
+# another, as handing them to workers costs more than it saves
+POOL_MIN_BYTES = 16 * 1024 * 1024
+# rows read between progress reports on a log
+PROGRESS_ROWS = 50000
+# bumped whenever cached segment entries change shape
+CACHE_VERSION = 1
 
 USE_EXISTING_OUTPUT_PATH = True
 
+# Known log layouts, matched in order by the headers they contain. When
+# filename_date is set the log start comes from "<date>_log.csv",
+# otherwise the file's modification time is used
+LOG_FORMATS = [
+    {
+        "name": "DS2",
+        "columns": {
+            "pedal": "Pedal(wped_w)(% PED)",
+            "eth": "Ethanol cont(ethanolpercent)(%)",
+            "gear": "Gear(gangi)()",
+            "map": "Map switch(mapswitch)(raw)",
+            "time": "Time(s)",
+        },
+        "filename_date": True,
+    },
+    {
+        "name": "DS1",
+        "columns": {
+            "pedal": "Pedal(%)",
+            "eth": "Ethanol(%)",
+            "gear": "Gear(-)",
+            "map": "Map switch(-)",
+            "time": "Time(s)",
+        },
+        "filename_date": False,
+    },
+]
+LOG_FORMAT_COLUMNS = ("pedal", "eth", "gear", "map", "time")
+
+
+class ProcessResult:
+    """Files and rows written for one log, and the error if it failed."""
+
+    def __init__(self, input_file="", error=""):
+        self.input_file = input_file
+        self.error = error
+        self.output_files = []
+        self.row_counts = {}
+        # seconds spent in each stage of reading the log
+        self.timings = {}
+        self.bytes_read = 0
+        # title, headers and sets of the log, kept for the batch output
+        self.sets = None
+
+    def add_output(self, output_filename, rows):
+        if output_filename not in self.row_counts:
+            self.output_files.append(output_filename)
+        self.row_counts[output_filename] = rows
+
+    @property
+    def rows_written(self):
+        return sum(self.row_counts.values())
+
 
 class DS2LogReader:
     def __init__(
@@ -25,6 +135,14 @@ class DS2LogReader:
         output_folder=None,
         output_prefix=None,
         group_wot=None,
+        engine=None,
+        streaming=None,
+        log_formats=None,
+        cache=None,
+        output_format=None,
+        filtered_headers=None,
+        chunk_workers=None,
+        combine_batch=None,
     ):
         self.input_date_format = (
             input_date_format if input_date_format else INPUT_DATE_FORMAT
@@ -47,11 +165,105 @@ class DS2LogReader:
         self.output_prefix = output_prefix if output_prefix else OUTPUT_PREFIX
 
         self.group_wot = group_wot if group_wot else GROUP_WOT
+        self.engine = engine if engine else ENGINE
+        self.streaming = streaming if streaming else STREAMING
+        self.output_format = output_format if output_format else OUTPUT_FORMAT
+        # columns to write, in order, every column when empty
+        self.filtered_headers = filtered_headers if filtered_headers else []
+        self.chunk_workers = chunk_workers if chunk_workers else CHUNK_WORKERS
+        self.combine_batch = combine_batch if combine_batch else COMBINE_BATCH
+
+        # user defined formats are tried before the built in ones
+        self.log_formats = (log_formats if log_formats else []) + LOG_FORMATS
+        self.column_cache = {}
+        # optional SegmentCache of the sets found in previously seen logs
+        self.cache = cache
 
         self.batch_start_time = None
         self.output_path_created = False
         self.output_path = ""
         self.file_list = []
+        self.batch_output = None
+        self.timings = {}
+        self.lap_time = time.perf_counter()
+        # log being read, and what is told how far through it reading is
+        self.reading = None
+        self.on_progress = None
+
+    def __getstate__(self):
+        # copies sent to worker processes leave the batch output, and its
+        # open files, with the reader that is writing it
+        state = self.__dict__.copy()
+        state["batch_output"] = None
+        return state
+
+    def process_files(
+        self, filepaths, max_workers=None, on_complete=None, on_progress=None
+    ):
+        # Process a batch across a pool of worker processes. on_complete is
+        # called with each ProcessResult as its file finishes, results are
+        # returned in the order of filepaths. on_progress is called with a
+        # log, and the rows and bytes of it read, every PROGRESS_ROWS rows
+        if not self.batch_start_time:
+            self.batch_start_time = datetime.now()
+            result = self.create_output_folders()
+            if result != "":
+                return [
+                    ProcessResult(filepath, error=result)
+                    for filepath in filepaths
+                ]
+
+        # more workers than cores only adds the cost of starting them
+        cores = os.cpu_count() or 1
+        max_workers = min(max_workers, cores) if max_workers else cores
+
+        results = {}
+        if (
+            max_workers == 1
+            or len(filepaths) <= 1
+            or sum(os.path.getsize(path) for path in filepaths)
+            < POOL_MIN_BYTES
+        ):
+            self.on_progress = on_progress
+            try:
+                for filepath in filepaths:
+                    results[filepath] = self.process_file(filepath)
+                    self.add_to_batch(results[filepath])
+                    if on_complete:
+                        on_complete(results[filepath])
+            finally:
+                self.on_progress = None
+
+            return [results[filepath] for filepath in filepaths]
+
+        pool = worker_pool(max_workers)
+        # cores left over when there are fewer logs than workers go to
+        # indexing each log in chunks
+        worker = copy.copy(self)
+        worker.chunk_workers = max(1, self.chunk_workers // len(filepaths))
+        if on_progress:
+            worker.on_progress = pool.reporter(on_progress)
+        futures = {}
+        try:
+            for filepath in filepaths:
+                futures[pool.submit(worker.process_file, filepath)] = filepath
+            for future in as_completed(futures):
+                filepath = futures[future]
+                results[filepath] = future.result()
+                # workers only update their own copy of the reader
+                for output_filename in results[filepath].output_files:
+                    self.add_output(output_filename)
+                self.add_to_batch(results[filepath])
+                if on_complete:
+                    on_complete(results[filepath])
+        finally:
+            # the pool is kept for the next batch, only its logs are dropped
+            for future in futures:
+                future.cancel()
+            if worker.on_progress:
+                pool.forget(worker.on_progress)
+
+        return [results[filepath] for filepath in filepaths]
 
     def process_file(self, filepath):
         # If this is the first file in the batch, create batch_start_time
@@ -59,100 +271,690 @@ class DS2LogReader:
             self.batch_start_time = datetime.now()
             result = self.create_output_folders()
             if result != "":
-                return result
+                return ProcessResult(filepath, error=result)
+
+        self.timings = {}
+        self.lap_time = time.perf_counter()
+        self.reading = filepath
+        result = self.read_file(filepath)
+        result.input_file = filepath
+        result.timings = self.timings
+        result.bytes_read = os.path.getsize(filepath)
+        for output_filename in result.output_files:
+            self.add_output(output_filename)
+
+        return result
+
+    def add_to_batch(self, result):
+        # Adds the sets of a finished log to the batch output. Their rows
+        # are read from the log here, so this is called before it is moved
+        if not self.combine_batch or result.sets is None:
+            return
 
+        title, headers, time_header, filtered_sets = result.sets
+        result.sets = None
+        if self.batch_output is None:
+            self.batch_output = BatchCombiner(self, self.combine_batch)
+        self.batch_output.add(title, headers, time_header, filtered_sets)
+
+    def finish_batch(self):
+        # ProcessResult of the batch output once every log has been added,
+        # None when there is no batch output
+        if self.batch_output is None:
+            return None
+
+        result = self.batch_output.finish()
+        self.batch_output = None
+        for output_filename in result.output_files:
+            self.add_output(output_filename)
+
+        return result
+
+    def discard_batch(self):
+        # for a batch that was stopped, its partial output is removed
+        if self.batch_output is not None:
+            self.batch_output.discard()
+            self.batch_output = None
+
+    def read_file(self, filepath):
         file_basename = os.path.basename(filepath)
 
         with open(filepath, "r") as file:
-            # this does not allow flexible input formats
-            if file_basename == "ds1.csv":
-                in_datetime = datetime
-                pedal_header = "Pedal(%)"
-                eth_header = "Ethanol(%)"
-                gear_header = "Gear(-)"
-                map_header = "Map switch(-)"
-                time_header = "Time(s)"
-            else:
-                in_datetime = datetime.strptime(
-                    file_basename.split("_log.csv")[0], self.input_date_format
-                )
-                pedal_header = "Pedal(wped_w)(% PED)"
-                eth_header = "Ethanol cont(ethanolpercent)(%)"
-                gear_header = "Gear(gangi)()"
-                map_header = "Map switch(mapswitch)(raw)"
-                time_header = "Time(s)"
-
             reader = csv.reader(file)
             title = next(reader)  # get the title line
             headers = next(reader)  # get the headers line
 
-            # get the indexes for various relevent columns
-            # this may need to be altered to allow flexible thresholding
-            index = headers.index(pedal_header)
-            eth_index = headers.index(eth_header)
-            gear_index = headers.index(gear_header)
-            map_index = headers.index(map_header)
-            time_index = headers.index(time_header)
-
-            # Initial data for loop
-            meta_data = {"map": -1, "eth": -1, "gears": [], "set_start": None}
-            hits_max_threshold = False
-
-            # iterate through the lines and group them into sets of contiguous lines that meet the criteria
-            filtered_sets = []
-            current_set = []
-            for line in reader:
-                # Polling rate for map is low, so we check if its there, and record it
-                if line[map_index]:
-                    meta_data["map"] = str(int(float(line[map_index])))
-                if line[eth_index]:
-                    meta_data["eth"] = str(int(round(float(line[eth_index]))))
-
-                # TODO: Create setting to allow misformed data
-                if line[index] == "":
-                    return ""
-                if float(line[index]) >= self.pedal_threshold:
-                    # this ensures its a WOT run - could use some refining because it.. doesn't
-                    if float(line[index]) >= self.mid_pedal_for_wot:
-                        hits_max_threshold = True
-                    if line[gear_index]:
-                        # checks for kickdown and if so  ignores initial gear
-                        if len(meta_data["gears"]) == 1:
-                            if meta_data["gears"][0] > line[gear_index]:
-                                meta_data["gears"] = []
-                        if line[gear_index] not in meta_data["gears"]:
-                            meta_data["gears"].append(line[gear_index])
-                    if not current_set:
-                        meta_data["set_start"] = in_datetime + timedelta(
-                            seconds=int(float(line[time_index]))
-                        )
-
-                    current_set.append(line)
-                elif current_set:
-                    if hits_max_threshold:
-                        hits_max_threshold = False
-                        filtered_sets.append((meta_data, current_set))
-                    current_set = []
-                    # Full reset is required
-                    meta_data = {
-                        "map": meta_data["map"],
-                        "eth": meta_data["eth"],
-                        "gears": [],
-                        "set_start": None,
-                    }
-            if current_set:
-                filtered_sets.append((meta_data, current_set))
-
-        return self.write_sets(
+            # get the indexes for various relevent columns before the body
+            # is read, so unknown layouts are rejected straight away
+            resolved = self.resolve_columns(headers)
+            if resolved is None:
+                error_msg = (
+                    f"ERROR: {file_basename} is not a recognised log format"
+                )
+                return ProcessResult(error=error_msg)
+            log_format, columns = resolved
+            self.lap("parse")
+
+            # formats name their own time column
+            time_header = headers[columns["time"]]
+            filtered_headers = self.project_headers(headers, time_header)
+            if filtered_headers == []:
+                error_msg = (
+                    f"ERROR: {file_basename} has none of the selected columns"
+                )
+                return ProcessResult(error=error_msg)
+
+            index = columns["pedal"]
+            eth_index = columns["eth"]
+            gear_index = columns["gear"]
+            map_index = columns["map"]
+            time_index = columns["time"]
+
+            if log_format.get("filename_date", False):
+                in_datetime = datetime.strptime(
+                    file_basename.split("_log.csv")[0],
+                    log_format.get("date_format", self.input_date_format),
+                )
+            else:
+                in_datetime = datetime.fromtimestamp(
+                    os.path.getmtime(filepath)
+                )
+
+            entry = None
+            if self.cache:
+                cache_key = self.cache_key(filepath, columns)
+                entry = self.cache.get(cache_key)
+                self.lap("cache")
+
+            if entry is not None:
+                filtered_sets = self.cached_sets(
+                    entry, filepath, file.encoding, in_datetime
+                )
+            elif self.streaming and not self.combine_batch:
+                # streamed sets are segmented and written in one pass, they
+                # are not kept for the batch output
+                return self.timed(
+                    "stream",
+                    self.stream_sets,
+                    reader,
+                    title,
+                    headers,
+                    in_datetime,
+                    index,
+                    eth_index,
+                    gear_index,
+                    map_index,
+                    time_index,
+                    filtered_headers,
+                    # bytes of the log read so far, csv reads ahead of the
+                    # row it is on by a buffer at most
+                    file.buffer.tell,
+                )
+            else:
+                filtered_sets = self.segment_file(
+                    filepath,
+                    file.encoding,
+                    reader,
+                    in_datetime,
+                    columns,
+                    file.buffer.tell,
+                )
+                # sets from the row loop have no byte ranges to keep
+                if self.cache and (
+                    filtered_sets is None
+                    or all(
+                        isinstance(segment.rows, SourceRows)
+                        for segment in filtered_sets
+                    )
+                ):
+                    self.cache.put(
+                        cache_key, self.cache_entry(filtered_sets, in_datetime)
+                    )
+            self.lap("segment")
+
+            # TODO: Create setting to allow misformed data
+            if filtered_sets is None:
+                return ProcessResult()
+
+        result = self.timed(
+            "write",
+            self.write_sets,
             title=title,
             headers=headers,
+            time_header=time_header,
             filtered_sets=filtered_sets,
-            # filtered_headers=[
-            #     "Time(s)",
-            #     "Ign earliest poss(zwbas)(Grad KW)",
-            #     "Eng spd(nmot_w)(1/min)",
-            # ],
+            filtered_headers=filtered_headers,
+        )
+        if self.combine_batch and result.error == "":
+            result.sets = (title, headers, time_header, filtered_sets)
+
+        return result
+
+    def report_progress(self, rows, bytes_read):
+        if self.on_progress:
+            self.on_progress(self.reading, rows, bytes_read)
+
+    def lap(self, stage):
+        # adds the time since the last lap to stage
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + (
+            now - self.lap_time
+        )
+        self.lap_time = now
+
+    def timed(self, stage, function, *args, **kwargs):
+        result = function(*args, **kwargs)
+        self.lap(stage)
+        return result
+
+    def project_headers(self, headers, time_header):
+        # The selected columns found in this log, in the order they were
+        # selected
+        if not self.filtered_headers:
+            return headers
+
+        filtered_headers = [
+            header for header in self.filtered_headers if header in headers
+        ]
+        # combined output rebases the time column, so it is always kept
+        if (
+            self.group_wot
+            and filtered_headers
+            and time_header not in filtered_headers
+        ):
+            filtered_headers.insert(0, time_header)
+
+        return filtered_headers
+
+    def segment_file(
+        self, filepath, encoding, reader, in_datetime, columns, position
+    ):
+        index = columns["pedal"]
+        eth_index = columns["eth"]
+        gear_index = columns["gear"]
+        map_index = columns["map"]
+        time_index = columns["time"]
+
+        if np is not None and (self.engine == "columnar" or self.cache):
+            # the cache keeps the pedal index for re-segmenting, and sets
+            # as byte ranges which only the fast engines record. The output
+            # is the same either way
+            segment = self.segment_columnar
+        elif self.engine == "bytes" or self.cache:
+            segment = self.segment_bytes
+        else:
+            segment = None
+
+        if segment:
+            try:
+                return segment(
+                    filepath,
+                    encoding,
+                    reader.line_num,
+                    in_datetime,
+                    index,
+                    eth_index,
+                    gear_index,
+                    map_index,
+                    time_index,
+                )
+            except ValueError:
+                # anything irregular is left to the row loop
+                pass
+
+        collector = self.segment_rows(
+            reader,
+            in_datetime,
+            index,
+            eth_index,
+            gear_index,
+            map_index,
+            time_index,
+            SetCollector(),
+            position=position,
+        )
+        return collector and collector.filtered_sets
+
+    def cache_key(self, filepath, columns):
+        # Segments only depend on the log and the pedal settings, anything
+        # else like group_wot just changes how they are written
+        settings = json.dumps(
+            [
+                CACHE_VERSION,
+                self.cache.file_digest(filepath),
+                self.pedal_threshold,
+                self.mid_pedal_for_wot,
+                columns,
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(settings.encode()).hexdigest()
+
+    def cache_entry(self, filtered_sets, in_datetime):
+        if filtered_sets is None:
+            return {"sets": None}
+
+        sets = []
+        for segment in filtered_sets:
+            rows = segment.rows
+            sets.append(
+                {
+                    "map": segment.map,
+                    "eth": segment.eth,
+                    "gears": segment.gears,
+                    # the same log may be uploaded under another name
+                    "offset": (
+                        segment.set_start - in_datetime
+                    ).total_seconds(),
+                    "start": rows.start,
+                    "end": rows.end,
+                    "rows": rows.row_count,
+                    "fields": rows.field_count,
+                    "crlf": bool(rows.crlf),
+                }
+            )
+
+        return {"sets": sets}
+
+    def cached_sets(self, entry, filepath, encoding, in_datetime):
+        if entry["sets"] is None:
+            return None
+
+        filtered_sets = []
+        for cached in entry["sets"]:
+            rows = SourceRows(
+                filepath,
+                cached["start"],
+                cached["end"],
+                cached["rows"],
+                cached["fields"],
+                cached["crlf"],
+                encoding,
+            )
+            filtered_sets.append(
+                WotSegment(
+                    rows,
+                    cached["gears"],
+                    cached["eth"],
+                    cached["map"],
+                    in_datetime + timedelta(seconds=cached["offset"]),
+                )
+            )
+
+        return filtered_sets
+
+    def resolve_columns(self, headers):
+        # Logs from one car share their headers, so the match is cached
+        key = tuple(headers)
+        if key in self.column_cache:
+            return self.column_cache[key]
+
+        positions = {}
+        for i, header in enumerate(headers):
+            positions.setdefault(header, i)
+
+        resolved = None
+        for log_format in self.log_formats:
+            names = log_format["columns"]
+            if all(names[column] in positions for column in names):
+                resolved = (
+                    log_format,
+                    {column: positions[names[column]] for column in names},
+                )
+                break
+
+        self.column_cache[key] = resolved
+        return resolved
+
+    def stream_sets(
+        self,
+        reader,
+        title,
+        headers,
+        in_datetime,
+        index,
+        eth_index,
+        gear_index,
+        map_index,
+        time_index,
+        filtered_headers=[],
+        position=None,
+    ):
+        if not self.output_path_created:
+            error_msg = "ERROR: Output folders have not been initialized"
+            print(error_msg)
+            return ProcessResult(error=error_msg)
+
+        error_msg = self.check_output_format()
+        if error_msg != "":
+            return ProcessResult(error=error_msg)
+
+        if filtered_headers == []:
+            filtered_headers = headers
+
+        header_indices = [headers.index(fh) for fh in filtered_headers]
+
+        spooler = SetSpooler(
+            self, title, filtered_headers, header_indices, headers[time_index]
+        )
+        try:
+            result = self.segment_rows(
+                reader,
+                in_datetime,
+                index,
+                eth_index,
+                gear_index,
+                map_index,
+                time_index,
+                spooler,
+                position=position,
+            )
+        except BaseException:
+            spooler.discard()
+            raise
+
+        # TODO: Create setting to allow misformed data
+        if result is None:
+            spooler.discard()
+            return ProcessResult()
+
+        return spooler.finish()
+
+    def segment_rows(
+        self,
+        rows,
+        in_datetime,
+        index,
+        eth_index,
+        gear_index,
+        map_index,
+        time_index,
+        sink,
+        encoding=None,
+        position=None,
+    ):
+        # rows are the fields of each line, as bytes when encoding is given.
+        # sink is given each row of a set, then the set when it closes.
+        # position returns the bytes of the log read, for progress reports
+        # Initial data for loop
+        map_value = -1
+        eth_value = -1
+        segment = None
+        hits_max_threshold = False
+
+        rows_read = 0
+        next_report = PROGRESS_ROWS if self.on_progress and position else 0
+
+        # iterate through the lines and group them into sets of contiguous lines that meet the criteria
+        for line in rows:
+            rows_read += 1
+            if rows_read == next_report:
+                next_report += PROGRESS_ROWS
+                self.report_progress(rows_read, position())
+
+            # Polling rate for map is low, so we check if its there, and record it
+            if line[map_index]:
+                map_value = str(int(float(line[map_index])))
+            if line[eth_index]:
+                eth_value = str(int(round(float(line[eth_index]))))
+
+            if not line[index]:
+                return None
+            pedal = float(line[index])
+            if pedal >= self.pedal_threshold:
+                # this ensures its a WOT run - could use some refining because it.. doesn't
+                if pedal >= self.mid_pedal_for_wot:
+                    hits_max_threshold = True
+                if segment is None:
+                    segment = WotSegment(
+                        None,
+                        [],
+                        eth_value,
+                        map_value,
+                        in_datetime
+                        + timedelta(seconds=int(float(line[time_index]))),
+                    )
+                segment.add_gear(line[gear_index], encoding)
+
+                sink.add_row(line)
+            elif segment is not None:
+                # meta data is read on the row that closes the set
+                segment.eth = eth_value
+                segment.map = map_value
+                sink.close_set(segment, hits_max_threshold)
+                hits_max_threshold = False
+                # Full reset is required
+                segment = None
+        if segment is not None:
+            segment.eth = eth_value
+            segment.map = map_value
+            sink.close_set(segment, True)
+
+        return sink
+
+    def segment_bytes(
+        self,
+        filepath,
+        encoding,
+        header_lines,
+        in_datetime,
+        index,
+        eth_index,
+        gear_index,
+        map_index,
+        time_index,
+    ):
+        # Same sets as segment_rows, but lines stay as raw bytes and only
+        # the inspected columns are split out and decoded. Each set is kept
+        # as the byte range of the file it came from
+        data = map_log(filepath)
+        if data is None:
+            return []
+
+        with data:
+            for i in range(header_lines):
+                data.readline()
+
+            collector = RangeCollector(self, filepath, encoding)
+            # no need to split past the last column that is looked at
+            lines = collector.split_lines(
+                data, max(index, eth_index, gear_index, map_index, time_index)
+            )
+            collector = self.segment_rows(
+                lines,
+                in_datetime,
+                index,
+                eth_index,
+                gear_index,
+                map_index,
+                time_index,
+                collector,
+                encoding,
+                data.tell,
+            )
+
+        return collector and collector.filtered_sets
+
+    def source_rows(
+        self, filepath, start, end, row_count, commas, crlf, encoding
+    ):
+        return SourceRows(
+            filepath,
+            start,
+            end,
+            row_count,
+            commas.pop() + 1 if len(commas) == 1 else None,
+            crlf,
+            encoding,
+        )
+
+    def segment_columnar(
+        self,
+        filepath,
+        encoding,
+        header_lines,
+        in_datetime,
+        index,
+        eth_index,
+        gear_index,
+        map_index,
+        time_index,
+    ):
+        # Same sets as segment_rows, but the relevant columns are parsed
+        # into a PedalIndex once and only rows of qualifying sets are split.
+        # An empty pedal is left to the row loop
+        pedal_index = self.load_pedal_index(
+            filepath,
+            encoding,
+            header_lines,
+            (index, eth_index, gear_index, map_index, time_index),
+        )
+        # the whole log has been read once it is indexed
+        self.report_progress(
+            len(pedal_index.pedal), int(pedal_index.line_starts[-1])
+        )
+        return self.index_sets(pedal_index, filepath, encoding, in_datetime)
+
+    def load_pedal_index(
+        self, filepath, encoding, header_lines, usecols, names=None, build=True
+    ):
+        # The index only depends on the log, so with a cache it is kept for
+        # re-segmenting with other settings. names limits the arrays read
+        # back from the cache, the others are None. Without build, None is
+        # returned when the index is not cached
+        if not self.cache:
+            if not build:
+                return None
+            return build_pedal_index(
+                filepath, encoding, header_lines, usecols, self.chunk_workers
+            )
+
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    CACHE_VERSION,
+                    "index",
+                    self.cache.file_digest(filepath),
+                    usecols,
+                ]
+            ).encode()
+        ).hexdigest()
+        arrays = self.cache.get_arrays(key, names)
+        if arrays is not None:
+            return PedalIndex(
+                **{name: arrays.get(name) for name in PedalIndex.NAMES}
+            )
+        if not build:
+            return None
+
+        pedal_index = build_pedal_index(
+            filepath, encoding, header_lines, usecols, self.chunk_workers
+        )
+        self.cache.put_arrays(key, pedal_index.arrays())
+        return pedal_index
+
+    def index_sets(self, pedal_index, filepath, encoding, in_datetime):
+        starts, ends = pedal_index.runs(
+            self.pedal_threshold, self.mid_pedal_for_wot
         )
+        if len(starts) == 0:
+            return []
+
+        row_count = len(pedal_index.pedal)
+        line_starts = pedal_index.line_starts
+
+        # view of the mapped file, this does not copy it. The map is not
+        # closed here as views of it may still be held, it is released
+        # along with the last of them
+        buffer = np.frombuffer(map_log(filepath), np.uint8)
+
+        filtered_sets = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            # meta data is read on the row that closes the set
+            close = min(end, row_count - 1)
+            map_value = pedal_index.map[close]
+            eth_value = pedal_index.eth[close]
+
+            segment = WotSegment(
+                None,
+                [],
+                (
+                    str(int(round(float(eth_value))))
+                    if not np.isnan(eth_value)
+                    else -1
+                ),
+                str(int(float(map_value))) if not np.isnan(map_value) else -1,
+                in_datetime + timedelta(seconds=int(pedal_index.time[start])),
+            )
+            for gear in pedal_index.gear[start:end].tolist():
+                segment.add_gear(gear)
+
+            # fields per row and line endings, counted over the mapped rows
+            set_starts = line_starts[start : end + 1]
+            rows_data = buffer[set_starts[0] : set_starts[-1]]
+            comma_rows = np.searchsorted(
+                set_starts,
+                np.flatnonzero(rows_data == 44) + set_starts[0],
+                side="right",
+            )
+            commas = set(
+                np.bincount(comma_rows - 1, minlength=end - start).tolist()
+            )
+            crlf = np.count_nonzero(rows_data == 13) == end - start and (
+                rows_data[-1] == 10
+            )
+
+            segment.rows = self.source_rows(
+                filepath,
+                int(set_starts[0]),
+                int(set_starts[-1]),
+                end - start,
+                commas,
+                crlf,
+                encoding,
+            )
+            filtered_sets.append(segment)
+
+        return filtered_sets
+
+    def preview(self, filepath, settings, cached_only=False):
+        # Number of sets each (pedal_threshold, mid_pedal_for_wot) pair
+        # would give, or None when the log can not be indexed. With
+        # cached_only, None is also given when its index is not cached yet
+        if np is None:
+            return None
+
+        try:
+            with open(filepath, "r") as file:
+                reader = csv.reader(file)
+                next(reader, None)
+                resolved = self.resolve_columns(next(reader, []))
+                if resolved is None:
+                    return None
+                columns = resolved[1]
+
+                pedal_index = self.load_pedal_index(
+                    filepath,
+                    file.encoding,
+                    reader.line_num,
+                    tuple(columns[column] for column in LOG_FORMAT_COLUMNS),
+                    names=("pedal",),
+                    build=not cached_only,
+                )
+        except ValueError:
+            return None
+        if pedal_index is None:
+            return None
+
+        counts = []
+        for pedal_threshold, mid_pedal_for_wot in settings:
+            starts, ends = pedal_index.runs(
+                pedal_threshold if pedal_threshold else PEDAL_THRESHOLD,
+                mid_pedal_for_wot if mid_pedal_for_wot else MIN_PEDAL_FOR_WOT,
+            )
+            counts.append(len(starts))
+
+        return counts
 
     def create_output_folders(self):
         if self.output_path_created:
@@ -177,11 +979,17 @@ class DS2LogReader:
 
         return ""
 
-    def write_sets(self, title, headers, filtered_sets, filtered_headers=[]):
+    def write_sets(
+        self, title, headers, time_header, filtered_sets, filtered_headers=[]
+    ):
         if not self.output_path_created:
             error_msg = "ERROR: Output folders have not been initialized"
             print(error_msg)
-            return error_msg
+            return ProcessResult(error=error_msg)
+
+        error_msg = self.check_output_format()
+        if error_msg != "":
+            return ProcessResult(error=error_msg)
 
         if filtered_headers == []:
             filtered_headers = headers
@@ -195,76 +1003,1132 @@ class DS2LogReader:
 
         else:
             return self.write_as_one(
-                title, filtered_headers, filtered_sets, header_indices
+                title,
+                filtered_headers,
+                filtered_sets,
+                header_indices,
+                time_header,
             )
 
+    def check_output_format(self):
+        if self.output_format not in OUTPUT_FORMATS:
+            return f"ERROR: {self.output_format} is not an output format"
+        table = self.output_format in ("feather", "parquet")
+        if table and importlib.util.find_spec("pyarrow") is None:
+            return f"ERROR: {self.output_format} output needs pyarrow"
+        if self.combine_batch and self.combine_batch not in COMBINE_ORDERS:
+            return f"ERROR: {self.combine_batch} is not a batch order"
+
         return ""
 
+    def open_output(self, output_filename):
+        # Returns the output file and a csv.writer, or a TableWriter that
+        # takes the same rows, for the output format
+        if self.output_format in ("feather", "parquet"):
+            output_file = TableWriter(output_filename, self.output_format)
+            return output_file, output_file
+
+        if self.output_format == "csv.gz":
+            # zlib's default level, 9 is far slower for little gain
+            output_file = gzip.open(
+                output_filename, "wt", compresslevel=6, newline=""
+            )
+        else:
+            output_file = open(output_filename, "w", newline="")
+
+        return output_file, csv.writer(output_file)
+
+    def add_output(self, output_filename):
+        if output_filename not in self.file_list:
+            self.file_list.append(output_filename)
+
+    def set_filename(self, segment):
+        time_output = segment.set_start.strftime(self.output_date_format)
+        return f"{time_output}_G{''.join(segment.gears)}_E{segment.eth}_M{segment.map}{OUTPUT_FORMATS[self.output_format]}"
+
     def write_as_individuals(
         self, title, filtered_headers, filtered_sets, header_indices
     ):
+        result = ProcessResult()
+
         # write each set of lines to a separate file
-        for i, filtered_set in enumerate(filtered_sets):
-            meta_data = filtered_set[0]
-            lines = filtered_set[1]
+        for segment in filtered_sets:
+            lines = segment.rows
 
-            time_output = meta_data["set_start"].strftime(
-                self.output_date_format
-            )
-            filename = f"{time_output}_G{''.join(meta_data['gears'])}_E{meta_data['eth']}_M{meta_data['map']}.csv"
+            filename = self.set_filename(segment)
             output_filename = os.path.join(self.output_path, filename)
 
-            with open(output_filename, "w", newline="") as output_file:
-                writer = csv.writer(output_file)
+            output_file, writer = self.open_output(output_filename)
+            with output_file:
                 writer.writerow(title)  # write the title line
                 writer.writerow(
                     filtered_headers
                 )  # write the filtered headers line
-                writer.writerows(
-                    [line[i] for i in header_indices] for line in lines
-                )  # write the filtered lines to the output file
+                if isinstance(lines, SourceRows):
+                    row_count = self.write_source_rows(
+                        output_file, writer, lines, header_indices
+                    )
+                else:
+                    writer.writerows(
+                        [line[i] for i in header_indices] for line in lines
+                    )  # write the filtered lines to the output file
+                    row_count = len(lines)
+            result.add_output(output_filename, row_count)
 
-        return ""
+        return result
+
+    def write_source_rows(self, output_file, writer, rows, header_indices):
+        # Rows still in the source log are copied across untouched when
+        # csv.writer would have produced the same bytes. The fast engines
+        # only keep logs without quotes, so with a column selection each
+        # row is cut up as bytes and none of the other columns are decoded
+        all_columns = header_indices == list(range(len(header_indices)))
+        if (
+            isinstance(writer, TableWriter)
+            or rows.field_count is None
+            or (all_columns and rows.field_count != len(header_indices))
+            or max(header_indices) >= rows.field_count
+            # csv.writer writes a lone empty field as ""
+            or len(header_indices) == 1
+        ):
+            writer.writerows(
+                [line[i] for i in header_indices] for line in rows
+            )
+            return rows.row_count
+
+        output_file.flush()
+        with open(rows.filepath, "rb") as source:
+            if all_columns and rows.crlf:
+                copy_range(source, output_file.buffer, rows.start, rows.end)
+                return rows.row_count
+
+            source.seek(rows.start)
+            lines = source.read(rows.end - rows.start)
+
+        if all_columns:
+            # csv.writer ends every row with \r\n
+            if not lines.endswith(b"\n"):
+                lines += b"\n"
+            output_file.buffer.write(
+                lines.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+            )
+            return rows.row_count
+
+        projected = []
+        for line in lines.split(b"\n"):
+            if line:
+                fields = line.rstrip(b"\r").split(b",")
+                projected.append(
+                    b",".join([fields[i] for i in header_indices])
+                )
+        projected.append(b"")
+        output_file.buffer.write(b"\r\n".join(projected))
+        return rows.row_count
 
     def write_as_one(
-        self, title, filtered_headers, filtered_sets, header_indices
+        self,
+        title,
+        filtered_headers,
+        filtered_sets,
+        header_indices,
+        time_header,
     ):
-        time_index = filtered_headers.index("Time(s)")
-
+        result = ProcessResult()
         if len(filtered_sets) == 0:
-            return ""
+            return result
 
         filename = (
-            filtered_sets[0][0]["set_start"].strftime(self.output_date_format)
-            + "_combined.csv"
+            filtered_sets[0].set_start.strftime(self.output_date_format)
+            + "_combined"
+            + OUTPUT_FORMATS[self.output_format]
         )
-        output_filename = os.path.join(self.output_path, filename)
-        with open(
-            output_filename,
-            "w",
-            newline="",
-        ) as output_file:
-            writer = csv.writer(output_file)
-            writer.writerow(title)
-            writer.writerow(filtered_headers)
-            end_time = 0.0
-            for filtered_set in filtered_sets:
-                offset = float(filtered_set[1][0][time_index]) - end_time
-                for row in filtered_set[1]:
-                    row[time_index] = str(
-                        round(float(row[time_index]) - offset, 3)
+        combined = CombinedWriter(
+            self,
+            os.path.join(self.output_path, filename),
+            title,
+            filtered_headers,
+            time_header,
+        )
+        with combined.output_file:
+            for segment in filtered_sets:
+                rows = segment.rows
+                if isinstance(rows, SourceRows):
+                    rows = rows.read()
+                combined.add(rows, header_indices)
+        result.add_output(combined.output_filename, combined.rows)
+
+        return result
+
+
+class WotSegment:
+    """One WOT run and what its output is named from. rows is the run's
+    SourceRows, or a list of the rows when the row loop read them."""
+
+    __slots__ = ("rows", "gears", "eth", "map", "set_start", "last_gear")
+
+    def __init__(self, rows, gears, eth, map, set_start):
+        self.rows = rows
+        self.gears = gears
+        self.eth = eth
+        self.map = map
+        self.set_start = set_start
+        self.last_gear = None
+
+    def add_gear(self, gear, encoding=None):
+        # The gear of the next row of the run, as bytes when encoding is
+        # given. The gear repeated from the row before changes nothing
+        if not gear or gear == self.last_gear:
+            return
+        self.last_gear = gear
+        if encoding is not None:
+            gear = gear.decode(encoding)
+        # checks for kickdown and if so  ignores initial gear
+        if len(self.gears) == 1 and self.gears[0] > gear:
+            self.gears = []
+        if gear not in self.gears:
+            self.gears.append(gear)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class SourceRows:
+    """Rows of a log kept as their byte range in the file until written."""
+
+    __slots__ = (
+        "filepath",
+        "start",
+        "end",
+        "row_count",
+        "field_count",
+        "crlf",
+        "encoding",
+    )
+
+    def __init__(
+        self, filepath, start, end, row_count, field_count, crlf, encoding
+    ):
+        self.filepath = filepath
+        self.start = start
+        self.end = end
+        self.row_count = row_count
+        # None when the rows do not all have the same number of fields
+        self.field_count = field_count
+        # every row already ends with \r\n
+        self.crlf = crlf
+        self.encoding = encoding
+
+    def __len__(self):
+        return self.row_count
+
+    def __iter__(self):
+        return iter(self.read())
+
+    def read(self):
+        with open(self.filepath, "rb") as source:
+            source.seek(self.start)
+            lines = source.read(self.end - self.start)
+        return list(csv.reader(io.StringIO(lines.decode(self.encoding))))
+
+
+class PedalIndex:
+    """Arrays of the columns sets are found from, one entry per row.
+
+    map and eth are carried forward from the last row that had them, NaN
+    before the first. line_starts has a final entry for the end of the log.
+    """
+
+    NAMES = ("pedal", "gear", "map", "eth", "time", "line_starts")
+
+    def __init__(self, pedal, gear, map, eth, time, line_starts):
+        self.pedal = pedal
+        self.gear = gear
+        self.map = map
+        self.eth = eth
+        self.time = time
+        self.line_starts = line_starts
+
+    def arrays(self):
+        return {
+            "pedal": self.pedal,
+            "gear": self.gear,
+            "map": self.map,
+            "eth": self.eth,
+            "time": self.time,
+            "line_starts": self.line_starts,
+        }
+
+    def runs(self, pedal_threshold, mid_pedal_for_wot):
+        # start and end rows of the runs above pedal_threshold that are
+        # kept, ends are exclusive
+        above = self.pedal >= pedal_threshold
+        edges = np.diff(above.astype(np.int8), prepend=0, append=0)
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        if len(starts) == 0:
+            return starts, ends
+
+        wot_count = np.concatenate(
+            ([0], np.cumsum(self.pedal >= mid_pedal_for_wot))
+        )
+        hits = wot_count[ends] > wot_count[starts]
+        # the last run is kept even if it never reaches WOT
+        hits[-1] = hits[-1] or ends[-1] == len(self.pedal)
+
+        return starts[hits], ends[hits]
+
+
+class TableWriter:
+    """Takes rows like csv.writer and writes them to a feather or parquet
+    file a batch of rows at a time. The first row is the title and the
+    second the headers.
+
+    Columns that are all numbers in the first batch are stored as floats,
+    a later value in one that is not a number is written as null. pyarrow
+    is only imported here, so workers writing csv never load it.
+    """
+
+    def __init__(self, filename, output_format):
+        self.filename = filename
+        self.output_format = output_format
+        self.title = None
+        self.headers = None
+        self.rows = []
+        self.schema = None
+        self.sink = None
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def writerow(self, row):
+        if self.title is None:
+            self.title = list(row)
+        elif self.headers is None:
+            self.headers = list(row)
+        else:
+            self.rows.append(row)
+            if len(self.rows) >= TABLE_BATCH_ROWS:
+                self.write_batch()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_batch(self):
+        import pyarrow as pa
+
+        types = []
+        columns = []
+        for i in range(len(self.headers)):
+            values = [row[i] if i < len(row) else "" for row in self.rows]
+            if self.schema is not None and self.schema.types[i] == pa.string():
+                types.append(pa.string())
+                columns.append(pa.array(values, pa.string()))
+                continue
+
+            try:
+                column = [
+                    float(value) if value != "" else None for value in values
+                ]
+                column_type = pa.float64()
+            except ValueError:
+                if self.schema is None:
+                    column, column_type = values, pa.string()
+                else:
+                    column = [parse_float(value) for value in values]
+                    column_type = pa.float64()
+            types.append(column_type)
+            columns.append(pa.array(column, column_type))
+
+        if self.schema is None:
+            self.schema = pa.schema(
+                list(zip(self.headers, types)),
+                metadata={"title": json.dumps(self.title)},
+            )
+            self.open_writer()
+
+        self.writer.write_table(
+            pa.Table.from_arrays(columns, schema=self.schema)
+        )
+        self.rows = []
+
+    def open_writer(self):
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        if self.output_format == "feather":
+            # the same file pyarrow.feather.write_feather would write
+            self.sink = pa.OSFile(self.filename, "wb")
+            self.writer = pyarrow.ipc.new_file(
+                self.sink,
+                self.schema,
+                options=pyarrow.ipc.IpcWriteOptions(
+                    compression=(
+                        "lz4" if pa.Codec.is_available("lz4") else None
                     )
-                    end_time = float(row[time_index])
-                    writer.writerow([row[i] for i in header_indices])
-                for i in range(20):
-                    end_time += 0.05
-                    row = [str(round(end_time))] + ["0"] * (
-                        len(filtered_headers) - 1
+                ),
+            )
+        else:
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.filename, self.schema
+            )
+
+    def close(self):
+        if self.rows is None:
+            return
+
+        # a table with no rows still has its columns written
+        if self.rows or self.writer is None:
+            self.write_batch()
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        self.rows = None
+
+
+class CombinedWriter:
+    """Sets written one after another to a single output, each moved in
+    time to follow on from the last and padded with 20 rows of zeros.
+    Sets may be added from any number of logs."""
+
+    def __init__(
+        self, ds2, output_filename, title, filtered_headers, time_header
+    ):
+        self.output_filename = output_filename
+        self.output_file, self.writer = ds2.open_output(output_filename)
+        self.writer.writerow(title)
+        self.writer.writerow(filtered_headers)
+
+        self.time_index = filtered_headers.index(time_header)
+        self.width = len(filtered_headers)
+        self.end_time = 0.0
+        self.rows = 0
+        # rows and (offset, shift in milliseconds) of the set being added
+        self.set_rows = 0
+        self.origin = None
+
+        # padding rows only differ in their time, so csv output gets the
+        # text either side of it once
+        if isinstance(self.writer, TableWriter):
+            self.padding = None
+        else:
+            self.padding = (
+                "0," * self.time_index,
+                ",0" * (self.width - self.time_index - 1) + "\r\n",
+            )
+
+    def add(self, rows, header_indices):
+        self.add_rows(rows, header_indices)
+        self.end_set()
+
+    def add_rows(self, rows, header_indices):
+        # rows are rows of a log, header_indices are the output columns of
+        # that log. A set may be added a part at a time, end_set ends it
+        source_index = header_indices[self.time_index]
+        times = self.rebase([row[source_index] for row in rows])
+        for row, time in zip(rows, times):
+            line = [row[i] for i in header_indices]
+            line[self.time_index] = time
+            self.writer.writerow(line)
+        self.set_rows += len(rows)
+
+    def end_set(self):
+        end_time = self.end_time
+        labels = []
+        for i in range(20):
+            end_time += 0.05
+            labels.append(str(round(end_time)))
+        self.end_time = end_time + 0.05
+
+        if self.padding is None:
+            for label in labels:
+                row = ["0"] * self.width
+                row[self.time_index] = label
+                self.writer.writerow(row)
+        else:
+            prefix, suffix = self.padding
+            self.output_file.write(
+                "".join(prefix + label + suffix for label in labels)
+            )
+
+        # every set is followed by 20 rows of padding
+        self.rows += self.set_rows + 20
+        self.set_rows = 0
+        self.origin = None
+
+    def rebase(self, times):
+        # The times of a set as str(round(time - offset, 3)), where offset
+        # moves the first time of the set to end_time. When the first has
+        # no more than millisecond precision, times that also do not are
+        # moved as whole milliseconds, all at once
+        if not times:
+            return []
+
+        if self.origin is None:
+            first = float(times[0])
+            shift = None
+            if math.isfinite(first):
+                milliseconds = round(first * 1000)
+                if abs(first * 1000 - milliseconds) < 1e-6:
+                    shift = milliseconds - round(self.end_time * 1000)
+            self.origin = (first - self.end_time, shift)
+        offset, shift = self.origin
+
+        if np is not None and shift is not None:
+            try:
+                seconds = np.array(times, dtype=float)
+            except ValueError:
+                seconds = None
+            if seconds is not None:
+                milliseconds = np.rint(seconds * 1000)
+                if np.all(np.abs(seconds * 1000 - milliseconds) < 1e-6):
+                    rebased = (milliseconds - shift) / 1000
+                    self.end_time = float(rebased[-1])
+                    return [repr(time) for time in rebased.tolist()]
+
+        labels = []
+        for time in times:
+            self.end_time = round(float(time) - offset, 3)
+            labels.append(str(self.end_time))
+        return labels
+
+    def close(self):
+        self.output_file.close()
+
+
+class BatchCombiner:
+    """WOT runs of every log in a batch in one combined output, added as
+    each log finishes.
+
+    Runs in arrival order are written to the output as they are added.
+    Grouped runs are spooled instead and written out by group when the
+    batch is finished. The columns are those of the first log added, logs
+    without one of them are given empty values for it.
+    """
+
+    def __init__(self, ds2, order):
+        self.ds2 = ds2
+        self.order = order
+        self.title = None
+        self.columns = None
+        self.time_header = None
+        self.combined = None
+        self.seconds = 0.0
+
+        # (key, spool position, rows) of each spooled run
+        self.spooled = []
+        self.spool = None
+        self.spool_writer = None
+
+    def add(self, title, headers, time_header, filtered_sets):
+        if not filtered_sets:
+            return
+        started = time.perf_counter()
+
+        if self.columns is None:
+            self.title = title
+            self.columns = list(self.ds2.project_headers(headers, time_header))
+            # the time column is rebased, so it is always kept
+            if time_header not in self.columns:
+                self.columns.insert(0, time_header)
+            self.time_header = time_header
+        indices = [
+            headers.index(column) if column in headers else None
+            for column in self.columns
+        ]
+        # logs of other formats may name their time column differently
+        indices[self.columns.index(self.time_header)] = headers.index(
+            time_header
+        )
+
+        for segment in filtered_sets:
+            if None in indices:
+                rows = [
+                    [row[i] if i is not None else "" for i in indices]
+                    for row in segment.rows
+                ]
+            else:
+                rows = [[row[i] for i in indices] for row in segment.rows]
+
+            if self.order == "arrival":
+                self.write(rows)
+                self.combined.end_set()
+            else:
+                self.spool_run(segment, rows)
+
+        self.seconds += time.perf_counter() - started
+
+    def spool_run(self, segment, rows):
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile("w+", newline="")
+            self.spool_writer = csv.writer(self.spool)
+
+        eth = int(segment.eth)
+        if self.order == "gear":
+            key = (segment.gears, eth, segment.set_start)
+        else:
+            key = (eth, segment.gears, segment.set_start)
+        self.spooled.append((key, self.spool.tell(), len(rows)))
+        self.spool_writer.writerows(rows)
+
+    def write(self, rows):
+        # rows of a run, which is ended with combined.end_set
+        if self.combined is None:
+            self.combined = CombinedWriter(
+                self.ds2,
+                os.path.join(
+                    self.ds2.output_path,
+                    BATCH_OUTPUT + OUTPUT_FORMATS[self.ds2.output_format],
+                ),
+                self.title,
+                self.columns,
+                self.time_header,
+            )
+        self.combined.add_rows(rows, list(range(len(self.columns))))
+
+    def finish(self):
+        started = time.perf_counter()
+
+        if self.spool is not None:
+            # stable, so runs with the same key stay in arrival order
+            for key, position, row_count in sorted(
+                self.spooled, key=lambda run: run[0]
+            ):
+                self.spool.seek(position)
+                reader = csv.reader(self.spool)
+                for start in range(0, row_count, SPOOL_CHUNK_ROWS):
+                    rows = itertools.islice(
+                        reader, min(row_count - start, SPOOL_CHUNK_ROWS)
                     )
-                    writer.writerow(row)
-                end_time += 0.05
+                    self.write(list(rows))
+                self.combined.end_set()
+            self.spool.close()
+            self.spool = None
 
-        return ""
+        result = ProcessResult()
+        if self.combined is not None:
+            self.combined.close()
+            result.add_output(
+                self.combined.output_filename, self.combined.rows
+            )
+        self.seconds += time.perf_counter() - started
+        result.timings = {"batch": self.seconds}
+
+        return result
+
+    def discard(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        if self.combined is not None:
+            self.combined.close()
+            os.remove(self.combined.output_filename)
+            self.combined = None
+
+
+class SetCollector:
+    """Keeps every qualifying set in memory for write_sets."""
+
+    def __init__(self):
+        self.filtered_sets = []
+        self.current_set = []
+
+    def add_row(self, line):
+        self.current_set.append(line)
+
+    def close_set(self, segment, keep):
+        if keep:
+            segment.rows = self.current_set
+            self.filtered_sets.append(segment)
+        self.current_set = []
+
+
+class RangeCollector:
+    """Keeps every qualifying set as the byte range of the log it came
+    from, for the raw lines read by split_lines."""
+
+    def __init__(self, ds2, filepath, encoding):
+        self.ds2 = ds2
+        self.filepath = filepath
+        self.encoding = encoding
+        self.filtered_sets = []
+
+        # the line last split and where it starts in the file
+        self.line = None
+        self.offset = 0
+        # where the set being read starts, None between sets
+        self.start = None
+
+    def split_lines(self, data, last_index):
+        # fields of each line of data up to last_index, which every line
+        # must have
+        self.offset = data.tell()
+        for line in iter(data.readline, b""):
+            fields = line.rstrip(b"\r\n").split(b",", last_index + 1)
+            if len(fields) <= last_index:
+                raise ValueError("Short row")
+            self.line = line
+            yield fields
+            self.offset += len(line)
+
+    def add_row(self, fields):
+        line = self.line
+        if self.start is None:
+            self.start = self.offset
+            self.row_count = 0
+            self.commas = set()
+            self.crlf = True
+        self.row_count += 1
+        self.commas.add(line.count(b","))
+        self.crlf = self.crlf and line.endswith(b"\r\n")
+        self.end = self.offset + len(line)
+
+    def close_set(self, segment, keep):
+        if keep:
+            segment.rows = self.ds2.source_rows(
+                self.filepath,
+                self.start,
+                self.end,
+                self.row_count,
+                self.commas,
+                self.crlf,
+                self.encoding,
+            )
+            self.filtered_sets.append(segment)
+        self.start = None
+
+
+class SetSpooler:
+    """Writes each set to disk as it is read, naming it when it closes."""
+
+    def __init__(
+        self, ds2, title, filtered_headers, header_indices, time_header
+    ):
+        self.ds2 = ds2
+        self.title = title
+        self.filtered_headers = filtered_headers
+        self.header_indices = header_indices
+        self.time_header = time_header
+
+        self.spool = None
+        self.spool_writer = None
+        self.spool_rows = 0
+        self.result = ProcessResult()
+
+        # combined output is only opened once the first set qualifies
+        self.combined = None
+
+    def add_row(self, line):
+        if self.spool is None:
+            self.open_spool()
+        self.spool_rows += 1
+        if self.ds2.group_wot:
+            self.spool_writer.writerow(line)
+        else:
+            self.spool_writer.writerow([line[i] for i in self.header_indices])
+
+    def open_spool(self):
+        if self.ds2.group_wot:
+            self.spool = tempfile.TemporaryFile("w+", newline="")
+            self.spool_writer = csv.writer(self.spool)
+            return
+
+        self.spool = tempfile.NamedTemporaryFile(
+            "w",
+            newline="",
+            dir=self.ds2.output_path,
+            prefix=".",
+            suffix=".part",
+            delete=False,
+        )
+        self.spool_writer = csv.writer(self.spool)
+        self.spool_writer.writerow(self.title)
+        self.spool_writer.writerow(self.filtered_headers)
+
+    def close_set(self, segment, keep):
+        rows = self.spool_rows
+        self.spool_rows = 0
+        if self.ds2.group_wot:
+            if keep:
+                self.append_combined(segment)
+            self.spool.seek(0)
+            self.spool.truncate()
+            return
+
+        self.spool.close()
+        if keep:
+            output_filename = os.path.join(
+                self.ds2.output_path, self.ds2.set_filename(segment)
+            )
+            if self.ds2.output_format == "csv":
+                os.replace(self.spool.name, output_filename)
+            else:
+                # sets are spooled as csv and converted once kept
+                output_file, writer = self.ds2.open_output(output_filename)
+                with output_file, open(self.spool.name, newline="") as spool:
+                    writer.writerows(csv.reader(spool))
+                os.remove(self.spool.name)
+            self.result.add_output(output_filename, rows)
+        else:
+            os.remove(self.spool.name)
+        self.spool = None
+
+    def append_combined(self, segment):
+        if self.combined is None:
+            filename = (
+                segment.set_start.strftime(self.ds2.output_date_format)
+                + "_combined"
+                + OUTPUT_FORMATS[self.ds2.output_format]
+            )
+            self.combined = CombinedWriter(
+                self.ds2,
+                os.path.join(self.ds2.output_path, filename),
+                self.title,
+                self.filtered_headers,
+                self.time_header,
+            )
+
+        self.spool.seek(0)
+        reader = csv.reader(self.spool)
+        while True:
+            rows = list(itertools.islice(reader, SPOOL_CHUNK_ROWS))
+            if not rows:
+                break
+            self.combined.add_rows(rows, self.header_indices)
+        self.combined.end_set()
+        self.result.add_output(
+            self.combined.output_filename, self.combined.rows
+        )
+
+    def finish(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        if self.combined is not None:
+            self.combined.close()
+
+        return self.result
+
+    def discard(self):
+        # nothing is kept from a log that could not be fully read
+        if self.spool is not None:
+            self.spool.close()
+            if not self.ds2.group_wot:
+                os.remove(self.spool.name)
+            self.spool = None
+        if self.combined is not None:
+            self.combined.close()
+        for output_filename in self.result.output_files:
+            os.remove(output_filename)
+        self.result = ProcessResult()
+
+
+# progress of the tasks of a worker process, set when the worker starts
+progress_reports = None
+
+
+def set_progress_reports(reports):
+    global progress_reports
+    progress_reports = reports
+
+
+class Reporter:
+    """Passes what it is called with from a worker process on to the
+    listener of its WorkerPool, see WorkerPool.reporter."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, *args):
+        progress_reports.put((self.token, args))
+
+
+class WorkerPool:
+    """Worker processes for logs or parts of them, started on first use and
+    kept for later batches rather than started again for each one.
+
+    Workers are spawned rather than forked, so they never inherit locks
+    held by the threads of a web server. The pool is started again when a
+    worker dies.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor = None
+        # queue the workers report progress on, and who each report is for
+        self.reports = None
+        self.listeners = {}
+
+    def submit(self, function, *args):
+        with self.lock:
+            if self.executor is None:
+                self.start()
+            try:
+                return self.executor.submit(function, *args)
+            except BrokenProcessPool:
+                self.stop()
+                self.start()
+                return self.executor.submit(function, *args)
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.reports = context.Queue()
+        threading.Thread(
+            target=self.forward, args=(self.reports,), daemon=True
+        ).start()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=context,
+            initializer=set_progress_reports,
+            initargs=(self.reports,),
+        )
+
+    def stop(self):
+        # work already handed to the workers is still finished
+        self.executor.shutdown(wait=False)
+        self.executor = None
+        self.reports.put(None)
+        self.reports = None
+
+    def reporter(self, listener):
+        # A Reporter for tasks of this pool, calling it in a worker calls
+        # listener in this process until the reporter is forgotten
+        reporter = Reporter(uuid.uuid4().hex)
+        self.listeners[reporter.token] = listener
+        return reporter
+
+    def forget(self, reporter):
+        self.listeners.pop(reporter.token, None)
+
+    def forward(self, reports):
+        for token, args in iter(reports.get, None):
+            listener = self.listeners.get(token)
+            if listener is None:
+                continue
+            try:
+                listener(*args)
+            except Exception:
+                # progress is only ever informative
+                pass
+
+    def map(self, function, *iterables):
+        # results of function for each set of arguments, in order
+        futures = [self.submit(function, *args) for args in zip(*iterables)]
+        try:
+            return [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.stop()
+
+
+# the WorkerPool every reader in this process shares, see worker_pool
+shared_pool = None
+shared_pool_lock = threading.Lock()
+
+
+def worker_pool(max_workers):
+    # The shared WorkerPool, started again larger when it has fewer than
+    # max_workers workers
+    global shared_pool
+    with shared_pool_lock:
+        if shared_pool is None or shared_pool.max_workers < max_workers:
+            if shared_pool is not None:
+                shared_pool.close()
+            shared_pool = WorkerPool(max_workers)
+        return shared_pool
+
+
+def map_log(filepath):
+    # Maps a log read only, or returns None for an empty file. Logs the
+    # fast engines can not handle byte for byte raise ValueError
+    with open(filepath, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if data.find(b'"') != -1:
+        data.close()
+        raise ValueError("Quoted fields")
+    if re.search(rb"\r(?!\n)", data):
+        data.close()
+        raise ValueError("Mixed line endings")
+
+    return data
+
+
+def build_pedal_index(filepath, encoding, header_lines, usecols, workers=1):
+    # usecols are the pedal, eth, gear, map and time columns. Logs the
+    # index can not describe byte for byte, or with an empty pedal, raise
+    # ValueError. Large logs are split into chunks of whole rows that are
+    # scanned by up to workers processes, then joined in order
+    data = map_log(filepath)
+    if data is None:
+        empty = np.zeros(0)
+        return PedalIndex(empty, empty.astype(str), empty, empty, empty, empty)
+
+    # byte offset of the start of every data row, loadtxt skips blank
+    # lines so the counts only match when every line is a row
+    with data:
+        buffer = np.frombuffer(data, np.uint8)
+        line_starts = np.flatnonzero(buffer == 10) + 1
+        size = len(buffer)
+        del buffer
+    if len(line_starts) and line_starts[-1] == size:
+        line_starts = line_starts[:-1]
+    line_starts = np.concatenate(([0], line_starts))[header_lines:]
+    row_count = len(line_starts)
+    line_starts = np.append(line_starts, size)
+
+    # more workers than cores only adds the cost of starting them
+    workers = min(workers, os.cpu_count() or 1)
+    chunk_count = max(1, min(workers, (size - line_starts[0]) // CHUNK_SIZE))
+    bounds = np.linspace(0, row_count, chunk_count + 1).astype(int).tolist()
+    chunks = [
+        (filepath, encoding, int(line_starts[a]), b - a)
+        for a, b in zip(bounds[:-1], bounds[1:])
+    ]
+    if chunk_count == 1:
+        parts = [scan_chunk(*chunks[0], usecols)]
+    else:
+        parts = worker_pool(chunk_count).map(
+            scan_chunk, *zip(*chunks), [usecols] * chunk_count
+        )
+
+    # map and eth are carried forward across chunk edges, from the last
+    # value seen in any chunk before
+    pedal, gear, time, map_rows, map_values, eth_rows, eth_values = zip(*parts)
+    offsets = bounds[:-1]
+    return PedalIndex(
+        np.concatenate(pedal),
+        np.concatenate(gear),
+        fill_forward(
+            np.concatenate([r + o for r, o in zip(map_rows, offsets)]),
+            np.concatenate(map_values),
+            row_count,
+        ),
+        fill_forward(
+            np.concatenate([r + o for r, o in zip(eth_rows, offsets)]),
+            np.concatenate(eth_values),
+            row_count,
+        ),
+        np.concatenate(time),
+        line_starts,
+    )
+
+
+def scan_chunk(filepath, encoding, start, row_count, usecols):
+    # Columns of the row_count rows from byte start of a log, with map and eth
+    # as the rows that have a value and their values. Every line of the
+    # chunk is given to loadtxt, blank ones included
+    with open(filepath, "rb") as file, warnings.catch_warnings():
+        # blank lines and empty logs are checked below
+        warnings.simplefilter("ignore")
+        file.seek(start)
+        columns = np.loadtxt(
+            itertools.islice(file, row_count),
+            dtype=str,
+            delimiter=",",
+            comments=None,
+            usecols=usecols,
+            encoding=encoding,
+            ndmin=2,
+        )
+    if len(columns) != row_count:
+        raise ValueError("Blank lines")
+
+    pedal_col, eth_col, gear_col, map_col, time_col = columns.T
+    map_rows = np.flatnonzero(map_col != "")
+    eth_rows = np.flatnonzero(eth_col != "")
+    return (
+        parse_floats(pedal_col),
+        gear_col,
+        parse_floats(time_col),
+        map_rows,
+        parse_floats(map_col[map_rows]),
+        eth_rows,
+        parse_floats(eth_col[eth_rows]),
+    )
+
+
+def parse_float(value):
+    # None for values that are empty or not a number
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_floats(column):
+    # float() per value is quicker than astype on numpy strings
+    return np.fromiter(map(float, column.tolist()), np.float64, len(column))
+
+
+def fill_forward(rows, values, length):
+    # each row gets the value of the last of rows at or before it, NaN
+    # until then. Only the rows that have a value are given, they are sparse
+    if len(rows) == 0:
+        return np.full(length, np.nan)
+
+    last = np.searchsorted(rows, np.arange(length), side="right") - 1
+    return np.where(last >= 0, values[np.maximum(last, 0)], np.nan)
+
+
+def copy_range(source, destination, start, end):
+    # Copies bytes start:end of one file to another, in the kernel where
+    # sendfile is available and the destination is a plain file
+    destination.flush()
+    if hasattr(os, "sendfile") and isinstance(destination, io.BufferedWriter):
+        try:
+            while start < end:
+                sent = os.sendfile(
+                    destination.fileno(), source.fileno(), start, end - start
+                )
+                if sent == 0:
+                    break
+                start += sent
+            if start >= end:
+                return
+        except OSError:
+            pass
+
+    source.seek(start)
+    while start < end:
+        chunk = source.read(min(end - start, 1024 * 1024))
+        if not chunk:
+            break
+        destination.write(chunk)
+        start += len(chunk)
+
+
+def load_log_formats(filepath):
+    # Reads extra log formats from a json list shaped like LOG_FORMATS
+    with open(filepath, "r") as file:
+        log_formats = json.load(file)
+
+    for log_format in log_formats:
+        missing = [
+            column
+            for column in LOG_FORMAT_COLUMNS
+            if column not in log_format.get("columns", {})
+        ]
+        if "name" not in log_format or missing:
+            raise ValueError(
+                f"Log format {log_format.get('name')} in {filepath} is missing {missing or ['name']}"
+            )
+
+    return log_formats
 
 
 def get_unique_files(dir):
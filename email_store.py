@@ -0,0 +1,171 @@
+import threading
+import time
+import uuid
+
+from azure.core import MatchConditions
+from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+# seconds a record is trusted before it is read from the container again
+CACHE_TTL = 30.0
+# records kept before expired ones are dropped
+CACHE_ITEMS = 1000
+
+
+class LocalContainer:
+    """Records kept in memory, standing in for the Cosmos container when
+    there is no endpoint, such as in tests and local runs."""
+
+    def __init__(self, partition_field):
+        self.partition_field = partition_field
+        self.lock = threading.Lock()
+        self.items = {}
+
+    def read_item(self, item, partition_key):
+        with self.lock:
+            record = self.items.get((partition_key, item))
+        if record is None:
+            raise CosmosResourceNotFoundError(
+                status_code=404, message=f"{item} not found"
+            )
+        return dict(record)
+
+    def create_item(self, body):
+        key = (body[self.partition_field], body["id"])
+        with self.lock:
+            if key in self.items:
+                raise CosmosResourceExistsError(
+                    status_code=409, message=f"{body['id']} already exists"
+                )
+            return self.save(key, body)
+
+    def upsert_item(self, body, etag=None, match_condition=None):
+        key = (body[self.partition_field], body["id"])
+        with self.lock:
+            current = self.items.get(key)
+            if (
+                match_condition == MatchConditions.IfNotModified
+                and current is not None
+                and current["_etag"] != etag
+            ):
+                raise CosmosAccessConditionFailedError(
+                    status_code=412, message=f"{body['id']} was modified"
+                )
+            return self.save(key, body)
+
+    def save(self, key, body):
+        record = dict(body, _etag=uuid.uuid4().hex, _ts=int(time.time()))
+        self.items[key] = record
+        return dict(record)
+
+
+class EmailStore:
+    """Email verification records in one partition of a Cosmos container.
+
+    The container is opened once per process and its client keeps its
+    connections for every request after. Records read or written are
+    cached for ttl seconds, and writes of a cached record only succeed if
+    no other worker changed it since.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        key,
+        database,
+        container,
+        partition_field,
+        partition,
+        ttl=None,
+    ):
+        self.endpoint = endpoint
+        self.key = key
+        self.database = database
+        self.container_name = container
+        self.partition_field = partition_field
+        self.partition = partition
+        self.ttl = ttl if ttl is not None else CACHE_TTL
+
+        self.lock = threading.Lock()
+        self.handle = None
+        self.cache = {}
+
+    def container(self):
+        with self.lock:
+            if self.handle is None:
+                if self.endpoint:
+                    client = CosmosClient(self.endpoint, self.key)
+                    database = client.create_database_if_not_exists(
+                        id=self.database
+                    )
+                    self.handle = database.create_container_if_not_exists(
+                        id=self.container_name,
+                        partition_key=PartitionKey(
+                            path="/" + self.partition_field
+                        ),
+                    )
+                else:
+                    self.handle = LocalContainer(self.partition_field)
+            return self.handle
+
+    def read(self, item_id, fresh=False):
+        # Raises CosmosResourceNotFoundError when there is no record
+        if not fresh:
+            with self.lock:
+                cached = self.cache.get(item_id)
+            if cached is not None and cached[0] > time.monotonic():
+                return dict(cached[1])
+
+        record = self.container().read_item(
+            item=item_id, partition_key=self.partition
+        )
+        self.remember(record)
+        return dict(record)
+
+    def create(self, item):
+        record = self.container().create_item(item)
+        self.remember(record)
+        return record
+
+    def upsert(self, item):
+        with self.lock:
+            cached = self.cache.get(item["id"])
+        original = cached[1] if cached is not None else None
+
+        if original is None or "_etag" not in item:
+            record = self.container().upsert_item(item)
+        else:
+            try:
+                record = self.container().upsert_item(
+                    item,
+                    etag=item["_etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            except CosmosAccessConditionFailedError:
+                # another worker wrote it after it was cached here, only
+                # the fields changed by this request are applied to theirs
+                current = self.container().read_item(
+                    item=item["id"], partition_key=self.partition
+                )
+                current.update(
+                    (field, value)
+                    for field, value in item.items()
+                    if original.get(field) != value
+                )
+                record = self.container().upsert_item(current)
+
+        self.remember(record)
+        return record
+
+    def remember(self, record):
+        now = time.monotonic()
+        with self.lock:
+            self.cache[record["id"]] = (now + self.ttl, dict(record))
+            if len(self.cache) > CACHE_ITEMS:
+                for item_id in list(self.cache):
+                    if self.cache[item_id][0] <= now:
+                        del self.cache[item_id]
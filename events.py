@@ -0,0 +1,251 @@
+import collections
+import json
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# events kept per channel for clients that reconnect
+HISTORY = 500
+# seconds between comments that keep an idle stream open
+KEEPALIVE = 15.0
+# seconds between coalesced progress events
+PROGRESS_INTERVAL = 0.5
+
+KEY_PREFIX = "ds2lv:events:"
+
+
+def format_event(event):
+    # one server-sent event, its id is what the browser resumes from
+    return (
+        f"id:{event['id']}\n"
+        f"event:{event['type']}\n"
+        f"data:{json.dumps(event['data'])}\n\n"
+    )
+
+
+class LocalEventStore:
+    """Events for a single process, used when there is no Redis."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.condition = threading.Condition()
+        self.channels = {}
+
+    def publish(self, channel, data, type):
+        with self.condition:
+            events, last_id, updated = self.channels.get(
+                channel, (collections.deque(maxlen=HISTORY), 0, 0)
+            )
+            event = {"id": last_id + 1, "type": type, "data": data}
+            events.append(event)
+            self.channels[channel] = (events, event["id"], time.time())
+
+            # drop channels nobody published to for a while
+            expired = time.time() - self.ttl
+            for name in list(self.channels):
+                if self.channels[name][2] < expired:
+                    del self.channels[name]
+
+            self.condition.notify_all()
+
+    def listen(self, channel, last_id):
+        while True:
+            with self.condition:
+                events = self.events_after(channel, last_id)
+                if not events:
+                    self.condition.wait(KEEPALIVE)
+                    events = self.events_after(channel, last_id)
+
+            if not events:
+                yield None
+            for event in events:
+                last_id = event["id"]
+                yield event
+
+    def events_after(self, channel, last_id):
+        if channel not in self.channels:
+            return []
+        return [
+            event
+            for event in self.channels[channel][0]
+            if event["id"] > last_id
+        ]
+
+
+class RedisEventStore:
+    """Events shared by every web worker, kept in a capped Redis list for
+    replay and published on a channel of their own for live clients."""
+
+    def __init__(self, redis_url, ttl):
+        self.redis = redis.Redis.from_url(redis_url)
+        self.ttl = int(ttl)
+
+    def publish(self, channel, data, type):
+        key = KEY_PREFIX + channel
+        event = {
+            "id": self.redis.incr(key + ":id"),
+            "type": type,
+            "data": data,
+        }
+        raw = json.dumps(event)
+
+        pipe = self.redis.pipeline()
+        pipe.rpush(key, raw)
+        pipe.ltrim(key, -HISTORY, -1)
+        pipe.expire(key, self.ttl)
+        pipe.expire(key + ":id", self.ttl)
+        pipe.publish(key, raw)
+        pipe.execute()
+
+    def listen(self, channel, last_id):
+        key = KEY_PREFIX + channel
+        pubsub = self.redis.pubsub()
+        # subscribed before the history is read so nothing falls between
+        pubsub.subscribe(key)
+        try:
+            for raw in self.redis.lrange(key, 0, -1):
+                event = json.loads(raw)
+                if event["id"] > last_id:
+                    last_id = event["id"]
+                    yield event
+
+            while True:
+                message = pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=KEEPALIVE
+                )
+                if message is None:
+                    yield None
+                    continue
+                event = json.loads(message["data"])
+                if event["id"] > last_id:
+                    last_id = event["id"]
+                    yield event
+        finally:
+            pubsub.close()
+
+
+class EventChannels:
+    """Server-sent events on a channel per job, with the recent events of
+    each kept so a client that reconnects carries on from the last event
+    it saw."""
+
+    def __init__(self, ttl, redis_url=None):
+        # ttl is how long a channel's events are kept
+        if redis_url and redis is not None:
+            self.store = RedisEventStore(redis_url, ttl)
+        else:
+            self.store = LocalEventStore(ttl)
+
+    def publish(self, channel, data, type="process_update"):
+        self.store.publish(channel, data, type)
+
+    def stream(self, channel, last_id=0):
+        # text of the events after last_id, then of each new one as it is
+        # published, with a comment while idle so dropped clients are found
+        for event in self.store.listen(channel, last_id):
+            if event is None:
+                yield ":\n\n"
+            else:
+                yield format_event(event)
+
+
+class Progress:
+    """Batch progress published to a channel at most once an interval.
+
+    Files completed between two events are sent together, as are their
+    outputs, so a batch of many small logs does not flood the stream. Logs
+    still being read are sent with how far through each one reading is.
+    """
+
+    def __init__(
+        self, channels, channel, total_files, total_bytes, interval=None
+    ):
+        self.channels = channels
+        self.channel = channel
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval if interval is not None else PROGRESS_INTERVAL
+
+        self.lock = threading.Lock()
+        self.files = 0
+        self.rows = 0
+        self.bytes_read = 0
+        self.input_files = []
+        self.output_files = []
+        self.published = 0.0
+
+        # (rows, bytes read, size) of each log being read, and those done
+        self.reading = {}
+        self.done = set()
+        self.changed = False
+
+    def add(self, input_file, output_files, rows, bytes_read):
+        with self.lock:
+            self.files += 1
+            self.rows += rows
+            self.bytes_read += bytes_read
+            self.input_files.append(input_file)
+            self.output_files.extend(output_files)
+            self.reading.pop(input_file, None)
+            self.done.add(input_file)
+            self.changed = True
+            due = time.monotonic() - self.published >= self.interval
+
+        if due:
+            self.flush()
+
+    def update(self, input_file, rows, bytes_read, size):
+        # how far through a log that is still being read reading is, a
+        # report that arrives after the log finished is ignored
+        with self.lock:
+            if input_file in self.done:
+                return
+            self.reading[input_file] = (rows, bytes_read, size)
+            self.changed = True
+            due = time.monotonic() - self.published >= self.interval
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.changed:
+                return
+            bytes_read = self.bytes_read + sum(
+                read for rows, read, size in self.reading.values()
+            )
+            percent = (
+                round(100 * bytes_read / self.total_bytes)
+                if self.total_bytes
+                else 100
+            )
+            data = {
+                "message": (
+                    f"Processed {self.files} of {self.total_files} logs "
+                    f"({percent}%)"
+                ),
+                "status": "progress",
+                "inputFiles": self.input_files,
+                "outputFiles": self.output_files,
+                "filesDone": self.files,
+                "filesTotal": self.total_files,
+                "rowsWritten": self.rows,
+                "percent": percent,
+                "reading": {
+                    input_file: {
+                        "rows": rows,
+                        "percent": round(100 * read / size) if size else 100,
+                    }
+                    for input_file, (rows, read, size) in self.reading.items()
+                },
+            }
+            self.input_files = []
+            self.output_files = []
+            self.changed = False
+            self.published = time.monotonic()
+
+        self.channels.publish(self.channel, data)
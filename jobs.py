@@ -0,0 +1,202 @@
+import json
+import queue
+import threading
+import time
+import uuid
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+JOB_WORKERS = 2
+# jobs queued or running across every web worker before /process says 429
+JOB_QUEUE_SIZE = 8
+# seconds a queued or running job holds its place without being renewed,
+# so places held by a web worker that stopped are soon given back
+JOB_LEASE = 60
+
+KEY_PREFIX = "ds2lv:job:"
+ACTIVE_KEY = "ds2lv:jobs:active"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class LocalJobStore:
+    """Job status for a single process, used when there is no Redis."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.active = set()
+
+    def reserve(self, job_id, limit):
+        with self.lock:
+            if len(self.active) >= limit:
+                return False
+            self.active.add(job_id)
+            return True
+
+    def release(self, job_id):
+        with self.lock:
+            self.active.discard(job_id)
+
+    def renew(self, job_ids):
+        # jobs here stop with the process that holds them
+        pass
+
+    def save(self, job):
+        with self.lock:
+            self.jobs[job["id"]] = dict(job, updated=time.time())
+
+            # drop finished jobs nobody polled for
+            expired = time.time() - self.ttl
+            for job_id in list(self.jobs):
+                if self.jobs[job_id]["updated"] < expired:
+                    del self.jobs[job_id]
+
+    def load(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+
+class RedisJobStore:
+    """Job status shared by every web worker through Redis."""
+
+    def __init__(self, redis_url, ttl):
+        self.redis = redis.Redis.from_url(redis_url)
+        self.ttl = int(ttl)
+
+    def reserve(self, job_id, limit):
+        # a sorted set of leases rather than a counter, so jobs of a worker
+        # that stopped are forgotten once their lease runs out
+        now = time.time()
+        self.redis.zremrangebyscore(ACTIVE_KEY, "-inf", now)
+        self.redis.zadd(ACTIVE_KEY, {job_id: now + JOB_LEASE})
+        if self.redis.zcard(ACTIVE_KEY) > limit:
+            self.redis.zrem(ACTIVE_KEY, job_id)
+            return False
+        return True
+
+    def release(self, job_id):
+        self.redis.zrem(ACTIVE_KEY, job_id)
+
+    def renew(self, job_ids):
+        # only leases still held are renewed, a released job stays gone
+        if job_ids:
+            expires = time.time() + JOB_LEASE
+            self.redis.zadd(
+                ACTIVE_KEY, {job_id: expires for job_id in job_ids}, xx=True
+            )
+
+    def save(self, job):
+        self.redis.set(KEY_PREFIX + job["id"], json.dumps(job), ex=self.ttl)
+
+    def load(self, job_id):
+        raw = self.redis.get(KEY_PREFIX + job_id)
+        if not raw:
+            return None
+
+        job = json.loads(raw)
+        if job["status"] in ("queued", "running"):
+            # a job whose lease ran out was lost with its web worker
+            expires = self.redis.zscore(ACTIVE_KEY, job_id)
+            if expires is None or expires < time.time():
+                job["status"] = "failed"
+                job["error"] = "The server restarted, please try again."
+        return job
+
+
+class JobQueue:
+    """Bounded queue of background jobs run by a fixed pool of threads."""
+
+    def __init__(
+        self, ttl, workers=None, queue_size=None, redis_url=None, log=None
+    ):
+        # ttl is how long job status is kept for polling
+        self.workers = workers if workers else JOB_WORKERS
+        self.queue_size = queue_size if queue_size else JOB_QUEUE_SIZE
+        self.log = log if log else lambda message, filename=None: None
+
+        if redis_url and redis is not None:
+            self.store = RedisJobStore(redis_url, ttl)
+        else:
+            self.store = LocalJobStore(ttl)
+
+        self.queue = queue.Queue()
+        self.threads = []
+        self.heartbeat_thread = None
+        self.lock = threading.Lock()
+        # jobs of this process that hold a place, renewed by the heartbeat
+        self.held = set()
+
+    def submit(self, target, *args, owner=None):
+        job_id = uuid.uuid4().hex
+        if not self.store.reserve(job_id, self.queue_size):
+            raise QueueFull(f"{self.queue_size} jobs are already queued")
+        with self.lock:
+            self.held.add(job_id)
+
+        job = {
+            "id": job_id,
+            "owner": owner,
+            "status": "queued",
+            "result": None,
+            "error": "",
+        }
+        self.store.save(job)
+
+        # threads are started on first use so forking servers keep them
+        self.start_workers()
+        self.queue.put((job, target, args))
+
+        return job_id
+
+    def status(self, job_id):
+        return self.store.load(job_id)
+
+    def start_workers(self):
+        with self.lock:
+            if self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(
+                    target=self.heartbeat, daemon=True
+                )
+                self.heartbeat_thread.start()
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def heartbeat(self):
+        while True:
+            time.sleep(JOB_LEASE / 4)
+            with self.lock:
+                job_ids = list(self.held)
+            try:
+                self.store.renew(job_ids)
+            except Exception as e:
+                self.log(f"Could not renew jobs: {e}", "errors.log")
+
+    def run(self):
+        while True:
+            job, target, args = self.queue.get()
+            job["status"] = "running"
+            self.store.save(job)
+
+            try:
+                job["result"] = target(*args)
+                job["status"] = "done"
+            except Exception as e:
+                self.log(f"Job {job['id']} failed: {e}", "errors.log")
+                job["error"] = str(e)
+                job["status"] = "failed"
+            finally:
+                self.store.save(job)
+                self.store.release(job["id"])
+                with self.lock:
+                    self.held.discard(job["id"])
+                self.queue.task_done()
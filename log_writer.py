@@ -0,0 +1,172 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# a log file is rotated once it would grow past this many bytes
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+# seconds records may wait before they are written
+FLUSH_INTERVAL = 1.0
+BATCH_SIZE = 500
+
+
+class LogWriter:
+    """Appends JSON line records to files in a folder from a background
+    thread, so callers only ever put a record on a queue.
+
+    Every web worker process has a writer of its own on the same files. A
+    file another process rotated is opened again before it is written to,
+    and rotating holds a lock file so only one process moves the backups.
+    """
+
+    def __init__(
+        self,
+        folder,
+        max_bytes=None,
+        backups=None,
+        flush_interval=None,
+        batch_size=None,
+    ):
+        self.folder = folder
+        self.max_bytes = max_bytes if max_bytes else MAX_BYTES
+        self.backups = backups if backups else BACKUPS
+        self.flush_interval = (
+            flush_interval if flush_interval else FLUSH_INTERVAL
+        )
+        self.batch_size = batch_size if batch_size else BATCH_SIZE
+
+        self.queue = queue.Queue()
+        self.files = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def log(self, message, filename="std_out.log", **fields):
+        record = {
+            "time": datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
+            "message": message,
+        }
+        record.update(fields)
+
+        self.start()
+        self.queue.put((filename, record))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                break
+
+            # whatever else arrives within the interval goes in one write
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self.write(batch)
+            if stop:
+                break
+
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+    def write(self, batch):
+        lines = {}
+        for filename, record in batch:
+            lines.setdefault(filename, []).append(
+                json.dumps(record, default=str) + "\n"
+            )
+
+        for filename, records in lines.items():
+            try:
+                self.write_records(filename, records)
+            except OSError as e:
+                # logging must never take down the caller
+                print(f"Could not write to {filename}: {e}")
+
+    def write_records(self, filename, records):
+        # records are written in runs that fit in the file, rotating it
+        # between them. A record past max_bytes on its own gets a file
+        file = self.open(filename)
+        size = os.fstat(file.fileno()).st_size
+        data = []
+        for record in records:
+            if size and size + len(record) > self.max_bytes:
+                file.write("".join(data))
+                file.flush()
+                data = []
+                file = self.rotate(filename, file)
+                size = os.fstat(file.fileno()).st_size
+            data.append(record)
+            size += len(record)
+        file.write("".join(data))
+        file.flush()
+
+    def open(self, filename):
+        # The open file of filename, opened again when it has been rotated
+        # since, by this process or another one
+        path = os.path.join(self.folder, filename)
+        file = self.files.get(filename)
+        if file is not None and not self.is_current(path, file):
+            file.close()
+            file = None
+
+        if file is None:
+            os.makedirs(self.folder, exist_ok=True)
+            file = self.files[filename] = open(path, "a")
+
+        return file
+
+    def is_current(self, path, file):
+        try:
+            return os.path.samestat(os.stat(path), os.fstat(file.fileno()))
+        except FileNotFoundError:
+            return False
+
+    def rotate(self, filename, file):
+        # Moves file to the newest backup, unless another process already
+        # has, and returns the file now at its path. path.1 is the newest
+        # backup, the oldest past BACKUPS is dropped
+        path = os.path.join(self.folder, filename)
+        with open(path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.is_current(path, file):
+                for i in range(self.backups - 1, 0, -1):
+                    if os.path.exists(f"{path}.{i}"):
+                        os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+                os.replace(path, f"{path}.1")
+
+        return self.open(filename)
+
+    def close(self):
+        # writes everything still queued, then stops the thread
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,183 @@
+import atexit
+import heapq
+import itertools
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from email.message import EmailMessage
+
+try:
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail
+    from python_http_client.exceptions import HTTPError
+except ImportError:
+    SendGridAPIClient = None
+
+RETRIES = 5
+# seconds before the first retry, doubled for each one after
+BACKOFF = 2.0
+MAX_BACKOFF = 300.0
+# seconds queued emails are given to go out when the process exits
+CLOSE_TIMEOUT = 10.0
+
+
+class EmailRejected(Exception):
+    """The transport refused the email, sending it again will not help."""
+
+
+class SendGridTransport:
+    def __init__(self, api_key):
+        if SendGridAPIClient is None:
+            raise RuntimeError("sendgrid is not installed")
+        # one client, and its connection pool, for every email
+        self.client = SendGridAPIClient(api_key)
+
+    def send(self, email):
+        message = Mail(
+            from_email=email["from"],
+            to_emails=email["to"],
+            subject=email["subject"],
+            plain_text_content=email["content"],
+        )
+        try:
+            self.client.send(message)
+        except HTTPError as e:
+            # rate limits and server errors are worth another try
+            if e.status_code == 429 or e.status_code >= 500:
+                raise
+            raise EmailRejected(f"{e.status_code} {e.body}") from e
+
+
+class FileTransport:
+    """Writes each email to a .eml file, standing in for a mail service in
+    tests and local runs."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def send(self, email):
+        message = EmailMessage()
+        message["From"] = email["from"]
+        message["To"] = email["to"]
+        message["Subject"] = email["subject"]
+        message.set_content(email["content"])
+
+        os.makedirs(self.folder, exist_ok=True)
+        filename = (
+            datetime.now().strftime("%Y%m%d_%H%M%S_")
+            + uuid.uuid4().hex[:8]
+            + ".eml"
+        )
+        with open(os.path.join(self.folder, filename), "wb") as file:
+            file.write(message.as_bytes())
+
+
+class Mailer:
+    """Queue of outbound emails sent by a background thread, so requests
+    never wait on the mail service. Failed sends are retried with
+    exponential backoff."""
+
+    def __init__(
+        self, transport, retries=None, backoff=None, max_backoff=None, log=None
+    ):
+        self.transport = transport
+        self.retries = retries if retries is not None else RETRIES
+        self.backoff = backoff if backoff is not None else BACKOFF
+        self.max_backoff = max_backoff if max_backoff else MAX_BACKOFF
+        self.log = log if log else lambda message, filename=None: None
+
+        # (due, order, email), ordered so retries wait behind new emails
+        self.pending = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closing = False
+
+    def send(self, to_email, subject, content, from_email):
+        email = {
+            "to": to_email,
+            "subject": subject,
+            "content": content,
+            "from": from_email,
+            "attempts": 0,
+        }
+
+        self.start()
+        self.schedule(email, time.monotonic())
+
+    def schedule(self, email, due):
+        with self.condition:
+            heapq.heappush(self.pending, (due, next(self.order), email))
+            self.condition.notify()
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.pending:
+                        if self.closing:
+                            return
+                        self.condition.wait()
+                        continue
+                    wait = self.pending[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    if self.closing:
+                        # retries still waiting on their backoff are dropped
+                        for _, _, email in self.pending:
+                            self.log(
+                                f"Dropped email to {email['to']} on exit",
+                                "errors.log",
+                            )
+                        self.pending = []
+                        return
+                    self.condition.wait(wait)
+                _, _, email = heapq.heappop(self.pending)
+
+            self.deliver(email)
+
+    def deliver(self, email):
+        email["attempts"] += 1
+        try:
+            self.transport.send(email)
+        except EmailRejected as e:
+            self.log(f"Email to {email['to']} rejected: {e}", "errors.log")
+            return
+        except Exception as e:
+            if email["attempts"] > self.retries:
+                self.log(
+                    f"Gave up on email to {email['to']} after "
+                    f"{email['attempts']} attempts: {e}",
+                    "errors.log",
+                )
+                return
+
+            delay = min(
+                self.backoff * 2 ** (email["attempts"] - 1), self.max_backoff
+            )
+            self.log(
+                f"Email to {email['to']} failed, retrying in {delay:g}s: {e}",
+                "errors.log",
+            )
+            self.schedule(email, time.monotonic() + delay)
+            return
+
+        self.log(f"Sent email to {email['to']}")
+
+    def close(self, timeout=None):
+        # sends everything already due, then stops the thread
+        if self.thread is None or not self.thread.is_alive():
+            return
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join(timeout if timeout is not None else CLOSE_TIMEOUT)
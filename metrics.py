@@ -0,0 +1,107 @@
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "ds2lv"
+
+
+class JobMetrics:
+    """Time spent in each stage of one batch, with the bytes and rows it
+    went through."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.files = 0
+        self.errors = 0
+        self.bytes_read = 0
+        self.rows_written = 0
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(stage, time.perf_counter() - start)
+
+    def add_result(self, result):
+        # stages timed inside DS2LogReader for one log
+        self.files += 1
+        if result.error != "":
+            self.errors += 1
+        self.bytes_read += result.bytes_read
+        self.rows_written += result.rows_written
+        for stage, seconds in result.timings.items():
+            self.add_stage(stage, seconds)
+
+    def summary(self):
+        return {
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "stages": {
+                stage: round(seconds, 3)
+                for stage, seconds in self.stages.items()
+            },
+            "files": self.files,
+            "errors": self.errors,
+            "bytesRead": self.bytes_read,
+            "rowsWritten": self.rows_written,
+        }
+
+
+class Metrics:
+    """Counters for this process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.types = {}
+
+    def inc(self, name, value=1, metric_type="counter", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, metric_type)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        # a summary without quantiles, the sum and count are enough to
+        # graph rates and averages
+        self.inc(name + "_sum", seconds, "summary", **labels)
+        self.inc(name + "_count", 1, "summary", **labels)
+
+    def record_job(self, job_metrics):
+        summary = job_metrics.summary()
+        self.observe("job_seconds", summary["seconds"])
+        for stage, seconds in job_metrics.stages.items():
+            self.observe("stage_seconds", seconds, stage=stage)
+        self.inc("files_total", job_metrics.files - job_metrics.errors)
+        self.inc("file_errors_total", job_metrics.errors)
+        self.inc("bytes_read_total", job_metrics.bytes_read)
+        self.inc("rows_written_total", job_metrics.rows_written)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+            types = dict(self.types)
+
+        lines = []
+        typed = set()
+        for (name, labels), value in values:
+            # summaries are typed once under their base name
+            base = name.rsplit("_", 1)[0]
+            if types[name] == "summary" and base not in typed:
+                lines.append(f"# TYPE {PREFIX}_{base} summary")
+                typed.add(base)
+            elif types[name] != "summary" and name not in typed:
+                lines.append(f"# TYPE {PREFIX}_{name} {types[name]}")
+                typed.add(name)
+
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            if label_text:
+                label_text = "{" + label_text + "}"
+            lines.append(f"{PREFIX}_{name}{label_text} {value}")
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,74 @@
+import os
+import zipfile
+
+
+class OutputZip:
+    """Zip of an output folder, built up as each log's outputs are written.
+
+    Files already in the folder when it is created are added along with the
+    first new output, matching an archive of the whole folder. The zip is
+    written beside its final name and only moved there by close.
+    """
+
+    def __init__(self, zip_path, root):
+        self.zip_path = zip_path
+        self.root = root
+        self.part_path = zip_path + ".part"
+        self.zip_file = None
+        self.names = set()
+        self.rebuild = False
+
+        self.existing = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                self.existing.append(os.path.join(dirpath, filename))
+
+    def add(self, path):
+        if self.zip_file is None:
+            self.zip_file = zipfile.ZipFile(
+                self.part_path, "w", zipfile.ZIP_DEFLATED
+            )
+            for existing in self.existing:
+                self.write(existing)
+        self.write(path)
+
+    def write(self, path):
+        name = os.path.relpath(path, self.root)
+        if name in self.names:
+            # an output was overwritten after it was zipped, entries can
+            # not be replaced so the zip is redone from the folder on close
+            self.rebuild = True
+            return
+
+        self.names.add(name)
+        self.zip_file.write(path, name)
+
+    def close(self):
+        # Returns False when nothing was added, and no zip is written
+        if self.zip_file is None:
+            return False
+
+        self.zip_file.close()
+        if self.rebuild:
+            with zipfile.ZipFile(
+                self.part_path, "w", zipfile.ZIP_DEFLATED
+            ) as zip_file:
+                for dirpath, dirnames, filenames in os.walk(self.root):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        path = os.path.join(dirpath, filename)
+                        zip_file.write(path, os.path.relpath(path, self.root))
+
+        os.replace(self.part_path, self.zip_path)
+        self.zip_file = None
+        return True
+
+    def discard(self):
+        if self.zip_file is None:
+            return
+
+        self.zip_file.close()
+        self.zip_file = None
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
@@ -0,0 +1,194 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import ds2logreader
+
+PIPELINE_WORKERS = 1
+
+# settings that change what is written for a log
+OUTPUT_SETTINGS = (
+    "pedal_threshold",
+    "min_pedal_for_wot",
+    "group_wot",
+    "output_format",
+    "columns",
+    "combine_batch",
+)
+
+
+def settings_key(settings):
+    return json.dumps(
+        {name: settings.get(name) for name in OUTPUT_SETTINGS}, sort_keys=True
+    )
+
+
+def file_stamp(filepath):
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Prepared:
+    def __init__(self, key, stamp, folder, future):
+        self.key = key
+        self.stamp = stamp
+        self.folder = folder
+        self.future = future
+        self.created = time.time()
+
+
+class UploadPipeline:
+    """Processes each upload as it lands, with the settings the client had
+    when it was uploaded, into a staging folder of its own.
+
+    When the batch is processed, take hands back the result of each log
+    that was prepared with the same settings and has not changed since, and
+    the rest are processed then as before.
+    """
+
+    def __init__(
+        self,
+        folder,
+        ttl,
+        workers=None,
+        log_formats=None,
+        cache=None,
+        chunk_workers=None,
+    ):
+        self.folder = folder
+        # seconds before prepared outputs nobody collected are dropped
+        self.ttl = ttl
+        self.workers = workers if workers else PIPELINE_WORKERS
+        self.log_formats = log_formats
+        self.cache = cache
+        # processes each log being indexed is split across
+        self.chunk_workers = chunk_workers
+
+        self.lock = threading.Lock()
+        self.pool = ds2logreader.WorkerPool(self.workers)
+        self.prepared = {}
+        # future of the index being built for each log
+        self.warming = {}
+
+    def submit(self, session_id, filepath, settings):
+        self.expire()
+
+        key = settings_key(settings)
+        folder = os.path.join(self.folder, session_id, uuid.uuid4().hex)
+        ds2 = ds2logreader.DS2LogReader(
+            output_folder=folder,
+            pedal_threshold=settings.get("pedal_threshold"),
+            mid_pedal_for_wot=settings.get("min_pedal_for_wot"),
+            group_wot=settings.get("group_wot"),
+            engine=settings.get("engine"),
+            streaming=settings.get("streaming"),
+            log_formats=self.log_formats,
+            cache=self.cache,
+            output_format=settings.get("output_format"),
+            filtered_headers=settings.get("columns"),
+            combine_batch=settings.get("combine_batch"),
+        )
+
+        with self.lock:
+            future = self.pool.submit(ds2.process_file, filepath)
+            previous = self.prepared.pop((session_id, filepath), None)
+            self.prepared[(session_id, filepath)] = Prepared(
+                key, file_stamp(filepath), folder, future
+            )
+
+        if previous is not None:
+            self.drop(previous)
+
+    def warm(self, filepath):
+        # Indexes a log in a worker, so previews and processing of it read
+        # the cached index rather than building it in a web thread
+        if self.cache is None:
+            return
+
+        ds2 = ds2logreader.DS2LogReader(
+            log_formats=self.log_formats,
+            cache=self.cache,
+            chunk_workers=self.chunk_workers,
+        )
+        with self.lock:
+            for done in [p for p, f in self.warming.items() if f.done()]:
+                del self.warming[done]
+            self.warming[filepath] = self.pool.submit(
+                ds2.preview, filepath, []
+            )
+
+    def settle(self, filepaths):
+        # Called before filepaths are processed, so their index is not
+        # built twice. Indexing that has not started is dropped, and
+        # indexing that has is waited for and read from the cache
+        with self.lock:
+            futures = [
+                self.warming.pop(filepath)
+                for filepath in filepaths
+                if filepath in self.warming
+            ]
+        for future in futures:
+            if not future.cancel():
+                try:
+                    future.result()
+                except Exception:
+                    # processing builds the index itself
+                    pass
+
+    def take(self, session_id, filepath, settings, output_path):
+        # Returns the ProcessResult of a log prepared with settings, with
+        # its outputs moved into output_path, or None when it has to be
+        # processed again
+        with self.lock:
+            prepared = self.prepared.pop((session_id, filepath), None)
+        if prepared is None:
+            return None
+
+        try:
+            changed = prepared.stamp != file_stamp(filepath)
+            if changed or prepared.key != settings_key(settings):
+                self.drop(prepared)
+                return None
+            result = prepared.future.result()
+        except Exception:
+            self.drop(prepared)
+            return None
+
+        if result.error != "":
+            self.drop(prepared)
+            return None
+
+        output_files = result.output_files
+        row_counts = result.row_counts
+        result.output_files = []
+        result.row_counts = {}
+        for output_filename in output_files:
+            destination = os.path.join(
+                output_path, os.path.basename(output_filename)
+            )
+            os.replace(output_filename, destination)
+            result.add_output(destination, row_counts[output_filename])
+        shutil.rmtree(prepared.folder, ignore_errors=True)
+
+        return result
+
+    def expire(self):
+        expired = time.time() - self.ttl
+        with self.lock:
+            dropped = [
+                self.prepared.pop(key)
+                for key in list(self.prepared)
+                if self.prepared[key].created < expired
+            ]
+        for prepared in dropped:
+            self.drop(prepared)
+
+    def drop(self, prepared):
+        # outputs are removed once the worker is done writing them
+        prepared.future.cancel()
+        prepared.future.add_done_callback(
+            lambda future: shutil.rmtree(prepared.folder, ignore_errors=True)
+        )
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# bytes of entries kept before the least recently used are removed, pedal
+# indexes take roughly 45 bytes per row of their log
+CACHE_SIZE = 1024 * 1024 * 1024
+# file digests remembered in memory by each process
+DIGESTS = 1000
+
+
+class SegmentCache:
+    """Json entries and numpy arrays kept on disk, shared by every process
+    using the folder.
+
+    Reads touch an entry's modification time, so once the folder is over
+    max_size the entries that have gone unused longest are removed first.
+    """
+
+    def __init__(self, folder, max_size=None):
+        self.folder = folder
+        self.max_size = max_size if max_size else CACHE_SIZE
+        self.digests = {}
+
+    def path(self, key, suffix=".json"):
+        return os.path.join(self.folder, key + suffix)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "r") as file:
+                entry = json.load(file)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return entry
+
+    def put(self, key, entry):
+        self.write(self.path(key), "w", lambda file: json.dump(entry, file))
+
+    def get_arrays(self, key, names=None):
+        # names limits the arrays read to those given
+        path = self.path(key, ".npz")
+        try:
+            with np.load(path) as file:
+                arrays = {
+                    name: file[name]
+                    for name in file.files
+                    if names is None or name in names
+                }
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return arrays
+
+    def put_arrays(self, key, arrays):
+        self.write(
+            self.path(key, ".npz"), "wb", lambda file: np.savez(file, **arrays)
+        )
+
+    def file_digest(self, filepath):
+        # SHA-256 of a file, hashed once per version of it and kept in the
+        # folder so other processes and later requests skip the hashing
+        stat = os.stat(filepath)
+        version = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        if version in self.digests:
+            return self.digests[version]
+
+        key = hashlib.sha256(
+            json.dumps(["digest", *version]).encode()
+        ).hexdigest()
+        entry = self.get(key)
+        if entry is not None:
+            digest = entry["digest"]
+        else:
+            hasher = hashlib.sha256()
+            with open(filepath, "rb") as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+            self.put(key, {"digest": digest})
+
+        if len(self.digests) >= DIGESTS:
+            self.digests.clear()
+        self.digests[version] = digest
+        return digest
+
+    def write(self, path, mode, dump):
+        os.makedirs(self.folder, exist_ok=True)
+
+        # written aside and renamed, so readers never see half an entry
+        with tempfile.NamedTemporaryFile(
+            mode, dir=self.folder, prefix=".", suffix=".part", delete=False
+        ) as file:
+            dump(file)
+        os.replace(file.name, path)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        with os.scandir(self.folder) as scan:
+            for item in scan:
+                if not item.name.endswith((".json", ".npz")):
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, item.path))
+                total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
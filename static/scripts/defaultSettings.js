@@ -2,4 +2,7 @@ export const defaultSettings = {
     pedal_threshold: 80.0,
     min_pedal_for_wot: 99.0,
     group_wot: false,
+    output_format: "csv",
+    columns: [],
+    combine_batch: "",
 }
\ No newline at end of file
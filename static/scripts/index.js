@@ -25,12 +25,66 @@ document.addEventListener("DOMContentLoaded", (event) => {
     const restoreDefaultsButton = document.getElementById("restoreDefaultsButton");
 
     const joinWOTRunsCheckbox = document.getElementById("joinWOTRuns");
+    const outputFormat = document.getElementById("outputFormat");
+    const columnsInput = document.getElementById("columns");
+    const combineBatch = document.getElementById("combineBatch");
+
+    // Headers never contain commas, so they are entered as a csv line
+    const parseColumns = (value) => value.split(",").map((column) => column.trim()).filter((column) => column !== "");
 
     pedalThreshold.value = settings.pedal_threshold.toFixed(1);
     minWOTThreshold.value = settings.min_pedal_for_wot.toFixed(1);
     joinWOTRunsCheckbox.checked = settings.group_wot;
+    outputFormat.value = settings.output_format || defaultSettings.output_format;
+    columnsInput.value = (settings.columns || []).join(", ");
+    combineBatch.value = settings.combine_batch || defaultSettings.combine_batch;
+
+    const runPreview = document.getElementById("runPreview");
+
+    // Show how many WOT runs the uploads give at the thresholds entered.
+    // Only the latest request is shown, replies to earlier ones are dropped
+    let previewRequest = 0;
+    function updateRunPreview() {
+        const request = ++previewRequest;
+        fetch("/preview", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({
+                settings: [{
+                    pedal_threshold: parseFloat(pedalThreshold.value),
+                    min_pedal_for_wot: parseFloat(minWOTThreshold.value),
+                }],
+            }),
+        })
+            .then((response) => response.json())
+            .then((data) => {
+                if (request !== previewRequest)
+                    return;
+                const counts = Object.values(data.files).filter((count) => count !== null);
+                if (counts.length === 0) {
+                    runPreview.textContent = "";
+                    return;
+                }
+                const runs = counts.reduce((total, count) => total + count[0], 0);
+                runPreview.textContent = `${runs} WOT runs in ${counts.length} uploaded logs`;
+            })
+            .catch(() => {
+                runPreview.textContent = "";
+            });
+    }
+
+    // typing waits for a pause before asking again
+    let previewTimer = null;
+    function schedulePreview() {
+        clearTimeout(previewTimer);
+        previewTimer = setTimeout(updateRunPreview, 250);
+    }
+
+    pedalThreshold.addEventListener("input", schedulePreview);
+    minWOTThreshold.addEventListener("input", schedulePreview);
 
     settingsButton.addEventListener("click", () => {
+        updateRunPreview();
         settingsDialog.showModal();
     });
 
@@ -42,6 +96,9 @@ document.addEventListener("DOMContentLoaded", (event) => {
         settings.pedal_threshold = parseFloat(pedalThreshold.value);
         settings.min_pedal_for_wot = parseFloat(minWOTThreshold.value);
         settings.group_wot = joinWOTRunsCheckbox.checked;
+        settings.output_format = outputFormat.value;
+        settings.columns = parseColumns(columnsInput.value);
+        settings.combine_batch = combineBatch.value;
 
         if (saveSettings.checked)
             localStorage.setItem("savesettings", JSON.stringify(settings));
@@ -54,6 +111,9 @@ document.addEventListener("DOMContentLoaded", (event) => {
         pedalThreshold.value = settings.pedal_threshold.toFixed(1);
         minWOTThreshold.value = settings.min_pedal_for_wot.toFixed(1);
         joinWOTRunsCheckbox.checked = settings.group_wot;
+        outputFormat.value = settings.output_format;
+        columnsInput.value = settings.columns.join(", ");
+        combineBatch.value = settings.combine_batch;
     });
 
     // Get a reference to the dialog and the submit button
@@ -249,31 +309,17 @@ document.addEventListener("DOMContentLoaded", (event) => {
             tr.classList.remove("error");
             tr.classList.add("uploading");
 
-            // Upload the file
-            const formData = new FormData();
-            formData.append("file", files[i]);
-
-            // Use XMLHttpRequest instead of fetch
-            const xhr = new XMLHttpRequest();
-
-            // Listen to the 'progress' event
-            xhr.upload.addEventListener('progress', function (e) {
-                if (e.lengthComputable) {
-                    // Calculate the percentage of the upload
-                    const percentComplete = Math.round((e.loaded / e.total) * 100);
-                    totalUploaded += e.loaded - lastLoaded[i];
-                    lastLoaded[i] = e.loaded;
-                    // Update the status cell with the progress
-                    tdStatus.textContent = "Uploading (" + percentComplete + "%)";
-                    const totalPercentComplete = Math.round((totalUploaded / totalFileSize) * 100);
-                    processStatus.innerText = "Please wait for files to finish uploading (" + totalPercentComplete + "%)";
-                }
-            }, false);
-
-            // Listen to the 'load' event
-            xhr.addEventListener('load', function (e) {
-                // Update the status cell based on the HTTP status code
-                if (xhr.status == 200) {
+            // Upload the file in chunks, resuming after a failed chunk
+            uploadFile(files[i], function (loaded) {
+                const percentComplete = Math.round((loaded / filesize) * 100);
+                totalUploaded += loaded - lastLoaded[i];
+                lastLoaded[i] = loaded;
+                // Update the status cell with the progress
+                tdStatus.textContent = "Uploading (" + percentComplete + "%)";
+                const totalPercentComplete = Math.round((totalUploaded / totalFileSize) * 100);
+                processStatus.innerText = "Please wait for files to finish uploading (" + totalPercentComplete + "%)";
+            })
+                .then(() => {
                     tdStatus.textContent = "Complete";
                     tr.classList.remove("uploading");
                     tr.classList.add("completed");
@@ -285,25 +331,85 @@ document.addEventListener("DOMContentLoaded", (event) => {
                         processButton.disabled = false;
                         processStatus.innerText = "Uploading complete. Ready to Process";
                     }
-                } else {
-                    console.error("Error uploading file, status code: " + xhr.status);
+                })
+                .catch((error) => {
+                    console.error("Error uploading file:", error);
                     tdStatus.textContent = "Error";
+                    tr.classList.remove("uploading");
+                    tr.classList.add("error");
+                });
+        }
+    });
+
+    const CHUNK_SIZE = 8 * 1024 * 1024;
+    const CHUNK_RETRIES = 5;
+
+    // Send one chunk with its Content-Range, resolves with the server's reply
+    function sendChunk(file, start, onProgress) {
+        const end = Math.min(start + CHUNK_SIZE, file.size);
+        return new Promise((resolve, reject) => {
+            const xhr = new XMLHttpRequest();
+            xhr.upload.addEventListener('progress', function (e) {
+                onProgress(start + e.loaded);
+            }, false);
+            xhr.addEventListener('load', function () {
+                if (xhr.status == 200) {
+                    resolve(JSON.parse(xhr.responseText));
+                } else {
+                    reject({ status: xhr.status });
                 }
             });
-
-            // Listen to the 'error' event
-            xhr.addEventListener('error', function (e) {
-                console.error("Error:", e);
-                tdStatus.textContent = "Error";
-                tr.classList.remove("uploading");
-                tr.classList.add("error");
+            xhr.addEventListener('error', function () {
+                reject({ status: 0 });
             });
+            xhr.open("PUT", "/upload/" + encodeURIComponent(file.name), true);
+            xhr.setRequestHeader("Content-Type", "application/octet-stream");
+            // lets the server start on the file with the settings in use
+            xhr.setRequestHeader("X-Settings", JSON.stringify(settings));
+            // an empty file is sent as one empty chunk
+            xhr.setRequestHeader("Content-Range", file.size > 0
+                ? `bytes ${start}-${end - 1}/${file.size}`
+                : "bytes */0");
+            xhr.send(file.slice(start, end));
+        });
+    }
 
-            // Open and send the request
-            xhr.open("POST", "/", true);
-            xhr.send(formData);
+    // Upload a file chunk by chunk. After a failed chunk the server is asked
+    // how much it has, and the upload carries on from there
+    async function uploadFile(file, onProgress) {
+        let start = 0;
+        let failures = 0;
+        while (true) {
+            try {
+                const reply = await sendChunk(file, start, onProgress);
+                failures = 0;
+                start = reply.received;
+                onProgress(start);
+                if (reply.complete) {
+                    return;
+                }
+            } catch (error) {
+                // too large or not allowed, sending it again will not help
+                if (error.status == 401 || error.status == 413) {
+                    throw error;
+                }
+                failures += 1;
+                if (failures > CHUNK_RETRIES) {
+                    throw error;
+                }
+                await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** (failures - 1)));
+                const response = await fetch("/upload/" + encodeURIComponent(file.name));
+                if (response.ok) {
+                    const reply = await response.json();
+                    if (reply.complete) {
+                        onProgress(file.size);
+                        return;
+                    }
+                    start = reply.received;
+                }
+            }
         }
-    });
+    }
 
     // Sort the table rows based on the upload status
     function sortTableRows() {
@@ -335,44 +441,56 @@ document.addEventListener("DOMContentLoaded", (event) => {
 
         processStatus.innerText = "Starting...";
 
-        var source = new EventSource("/stream");
-        source.addEventListener('process_update', function (event) {
-            var data = JSON.parse(event.data);
-            if (data.message) {
-                processStatus.innerText = data.message;
-            }
-            if (data.status === "fileComplete") {
-                const rows = document.querySelectorAll("#filesBody tr");
-
-                rows.forEach((row) => {
-                    const fileNameCell = row.querySelector("td:first-child");
-                    const statusCell = row.querySelector("td:nth-child(3)");
+        // Events of this batch, the browser resumes from the last one it
+        // saw if the stream drops
+        var source = null;
+        function listen() {
+            source = new EventSource("/stream");
+            source.addEventListener('process_update', function (event) {
+                var data = JSON.parse(event.data);
+                if (data.message) {
+                    processStatus.innerText = data.message;
+                }
+                if (data.status === "progress") {
+                    const rows = document.querySelectorAll("#filesBody tr");
+
+                    rows.forEach((row) => {
+                        const fileNameCell = row.querySelector("td:first-child");
+                        const statusCell = row.querySelector("td:nth-child(3)");
+
+                        if (data.inputFiles.includes(fileNameCell.textContent)) {
+                            row.classList.remove("completed");
+                            row.classList.add("processed");
+                            statusCell.textContent = "Processed";
+                        } else if (data.reading && data.reading[fileNameCell.textContent]) {
+                            const reading = data.reading[fileNameCell.textContent];
+                            statusCell.textContent = "Processing (" + reading.percent + "%)";
+                        }
+                    });
+                }
+                if (data.status === "complete") {
+                    const rows = document.querySelectorAll("#filesBody tr");
 
-                    if (fileNameCell.textContent === data.inputFile) {
+                    rows.forEach((row) => {
                         row.classList.remove("completed");
                         row.classList.add("processed");
-                        statusCell.textContent = "Processed";
-                    }
-                });
-            }
-            if (data.status === "complete") {
-                const rows = document.querySelectorAll("#filesBody tr");
-
-                rows.forEach((row) => {
-                    row.classList.remove("completed");
-                    row.classList.add("processed");
-                });
+                    });
 
-                emailResultsButton.disabled = false;
-                downloadButton.disabled = false;
-                processButton.disabled = true;
-                source.close();
-            }
-            if (data.status === "empty") {
-                emptyDialog.showModal();
-                source.close();
-            }
-        }, false);
+                    emailResultsButton.disabled = false;
+                    downloadButton.disabled = false;
+                    processButton.disabled = true;
+                    source.close();
+                }
+                if (data.status === "empty") {
+                    emptyDialog.showModal();
+                    source.close();
+                }
+                if (data.status === "failed") {
+                    document.getElementById("uploadFileInput").disabled = false;
+                    source.close();
+                }
+            }, false);
+        }
 
         fetch("/process", {
             method: "POST",
@@ -382,7 +500,15 @@ document.addEventListener("DOMContentLoaded", (event) => {
             body: JSON.stringify({ settings }),
         })
             .then((response) => {
-                if (response.status !== 202) {
+                if (response.status === 202) {
+                    // the batch has its own channel, events published
+                    // before this connects are replayed
+                    listen();
+                } else if (response.status === 429) {
+                    // Every worker is busy, let the user try again
+                    processStatus.innerText = "Server busy, please try again shortly";
+                    document.getElementById("uploadFileInput").disabled = false;
+                } else {
                     console.error(
                         "Error starting processing, status code: " + response.status
                     );
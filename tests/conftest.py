@@ -0,0 +1,24 @@
+import os
+
+import ds2logreader
+from benchmarks import synth
+
+
+def make_log(folder, index=0, rows=6000, pulls=6):
+    # a synthetic log in folder, the same for the same index
+    path = os.path.join(str(folder), synth.log_filename(index=index))
+    synth.generate_log(path, rows, pulls=pulls, seed=index)
+    return path
+
+
+def process_outputs(folder, log, **settings):
+    # every output of the log by name, under its batch folder
+    ds2 = ds2logreader.DS2LogReader(output_folder=str(folder), **settings)
+    result = ds2.process_file(log)
+    assert result.error == ""
+
+    outputs = {}
+    for output_filename in result.output_files:
+        with open(output_filename, "rb") as file:
+            outputs[os.path.basename(output_filename)] = file.read()
+    return outputs
@@ -0,0 +1,69 @@
+import csv
+import os
+
+import pytest
+
+import ds2logreader
+from tests.conftest import make_log
+
+
+def make_logs(folder, count):
+    return [make_log(folder, i) for i in range(count)]
+
+
+def test_batch_output_with_prepared_log_and_pool(tmp_path, monkeypatch):
+    # a log added before the pool starts, as collect_prepared does, must
+    # not stop the reader being sent to the workers
+    monkeypatch.setattr(ds2logreader, "POOL_MIN_BYTES", 0)
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    paths = make_logs(str(tmp_path), 3)
+    ds2 = ds2logreader.DS2LogReader(
+        output_folder=str(tmp_path / "out"), combine_batch="gear"
+    )
+    prepared = ds2.process_files(paths[:1])
+    assert ds2.batch_output is not None
+
+    results = prepared + ds2.process_files(paths[1:], max_workers=2)
+    assert [result.error for result in results] == ["", "", ""]
+
+    batch = ds2.finish_batch()
+    (output_filename,) = batch.output_files
+    with open(output_filename, newline="") as file:
+        rows = list(csv.reader(file))
+    # every run is followed by 20 rows of padding
+    runs = sum(len(result.output_files) for result in results)
+    written = sum(result.rows_written for result in results)
+    assert len(rows) - 2 == written + 20 * runs == batch.rows_written
+
+
+def test_small_batch_stays_in_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    monkeypatch.setattr(
+        ds2logreader,
+        "worker_pool",
+        lambda max_workers: pytest.fail("small batch sent to workers"),
+    )
+    paths = make_logs(str(tmp_path), 2)
+    ds2 = ds2logreader.DS2LogReader(output_folder=str(tmp_path / "out"))
+    results = ds2.process_files(paths, max_workers=2)
+    assert [result.error for result in results] == ["", ""]
+
+
+@pytest.mark.parametrize("order", ["arrival", "gear"])
+def test_discarded_batch_leaves_no_output(tmp_path, order):
+    paths = make_logs(str(tmp_path), 2)
+    ds2 = ds2logreader.DS2LogReader(
+        output_folder=str(tmp_path / "out"), combine_batch=order
+    )
+    ds2.process_files(paths)
+    spool = ds2.batch_output.spool
+    assert (spool is None) == (order == "arrival")
+
+    ds2.discard_batch()
+    assert ds2.batch_output is None
+    assert spool is None or spool.closed
+    assert not [
+        filename
+        for filename in os.listdir(ds2.output_path)
+        if filename.startswith(ds2logreader.BATCH_OUTPUT)
+    ]
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+import ds2logreader
+import segment_cache
+from tests.conftest import make_log, process_outputs
+
+ROWS = 8000
+
+
+@pytest.fixture(params=[False, True], ids=["lf", "crlf"])
+def log(request, tmp_path):
+    path = make_log(tmp_path, index=3, rows=ROWS, pulls=8)
+    if request.param:
+        with open(path, "rb") as file:
+            data = file.read()
+        with open(path, "wb") as file:
+            file.write(data.replace(b"\n", b"\r\n"))
+    return path
+
+
+@pytest.mark.parametrize("group_wot", [False, True])
+@pytest.mark.parametrize(
+    "settings",
+    [{"engine": "columnar"}, {"engine": "bytes"}, {"streaming": True}],
+    ids=["columnar", "bytes", "streaming"],
+)
+def test_engines_match_row_loop(tmp_path, log, group_wot, settings):
+    expected = process_outputs(tmp_path / "rows", log, group_wot=group_wot)
+    assert expected
+    assert (
+        process_outputs(tmp_path / "out", log, group_wot=group_wot, **settings)
+        == expected
+    )
+
+
+@pytest.mark.parametrize("group_wot", [False, True])
+def test_cached_sets_match_row_loop(tmp_path, log, group_wot):
+    expected = process_outputs(tmp_path / "rows", log, group_wot=group_wot)
+    cache = segment_cache.SegmentCache(str(tmp_path / "cache"))
+
+    # the first run fills the cache and the second is read from it
+    for run in ("first", "second"):
+        outputs = process_outputs(
+            tmp_path / run, log, group_wot=group_wot, cache=cache
+        )
+        assert outputs == expected
+
+
+def test_preview_only_reads_cached_index(tmp_path, log):
+    cache = segment_cache.SegmentCache(str(tmp_path / "cache"))
+    ds2 = ds2logreader.DS2LogReader(cache=cache)
+    settings = [(None, None), (90, 10)]
+
+    # nothing is indexed until the log is warmed
+    assert ds2.preview(log, settings, cached_only=True) is None
+    assert ds2.preview(log, settings, cached_only=True) is None
+    counts = ds2.preview(log, settings)
+    assert counts[0] > 0
+    assert ds2.preview(log, settings, cached_only=True) == counts
+
+
+@pytest.mark.parametrize("group_wot", [False, True])
+def test_chunked_index_matches_row_loop(tmp_path, log, group_wot, monkeypatch):
+    expected = process_outputs(tmp_path / "rows", log, group_wot=group_wot)
+
+    monkeypatch.setattr(ds2logreader, "CHUNK_SIZE", 64 * 1024)
+    monkeypatch.setattr(os, "cpu_count", lambda: 3)
+    outputs = process_outputs(
+        tmp_path / "chunked",
+        log,
+        group_wot=group_wot,
+        engine="columnar",
+        chunk_workers=3,
+    )
+    assert outputs == expected
+
+
+def test_streamed_sets_combined_in_chunks(tmp_path, log, monkeypatch):
+    expected = process_outputs(tmp_path / "rows", log, group_wot=True)
+
+    # sets are read back from the spool a few rows at a time
+    monkeypatch.setattr(ds2logreader, "SPOOL_CHUNK_ROWS", 7)
+    outputs = process_outputs(
+        tmp_path / "out", log, group_wot=True, streaming=True
+    )
+    assert outputs == expected
@@ -0,0 +1,53 @@
+import events
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+
+    def publish(self, channel, data):
+        self.events.append(data)
+
+
+def test_progress_of_logs_being_read():
+    channels = Recorder()
+    progress = events.Progress(channels, "job", 2, 300, interval=0)
+
+    progress.update("a.csv", 1000, 50, 100)
+    progress.update("b.csv", 2000, 100, 200)
+    assert channels.events[-1]["percent"] == 50
+    assert channels.events[-1]["reading"] == {
+        "a.csv": {"rows": 1000, "percent": 50},
+        "b.csv": {"rows": 2000, "percent": 50},
+    }
+
+    progress.add("a.csv", ["a_out.csv"], 10, 100)
+    # a late report of a finished log changes nothing
+    progress.update("a.csv", 1000, 50, 100)
+    assert len(channels.events) == 3
+    assert channels.events[-1]["percent"] == 67
+    assert channels.events[-1]["inputFiles"] == ["a.csv"]
+    assert channels.events[-1]["reading"] == {
+        "b.csv": {"rows": 2000, "percent": 50}
+    }
+
+
+def test_stream_resumes_after_last_event_id(monkeypatch):
+    monkeypatch.setattr(events, "HISTORY", 3)
+    channels = events.EventChannels(60)
+    for i in range(1, 5):
+        channels.publish("job", {"n": i})
+    channels.publish("other", {"n": 0})
+
+    stream = channels.stream("job", last_id=2)
+    replayed = [next(stream), next(stream)]
+    assert replayed == [
+        events.format_event(
+            {"id": i, "type": "process_update", "data": {"n": i}}
+        )
+        for i in (3, 4)
+    ]
+
+    # a client further behind than the history gets what is kept
+    stream = channels.stream("job")
+    assert next(stream).startswith("id:2\n")
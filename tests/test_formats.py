@@ -0,0 +1,73 @@
+import pytest
+
+import ds2logreader
+from tests import conftest
+
+CUSTOM_FORMAT = {
+    "name": "Custom",
+    "columns": dict(ds2logreader.LOG_FORMATS[0]["columns"], time="T"),
+    "filename_date": True,
+}
+
+
+def make_log(folder, index=0, time_header="Time(s)"):
+    path = conftest.make_log(folder, index)
+    with open(path, "rb") as file:
+        data = file.read()
+    with open(path, "wb") as file:
+        file.write(data.replace(b"Time(s)", time_header.encode(), 1))
+    return path
+
+
+def process(folder, log, **settings):
+    return conftest.process_outputs(
+        folder, log, log_formats=[CUSTOM_FORMAT], **settings
+    )
+
+
+@pytest.mark.parametrize("group_wot", [False, True])
+@pytest.mark.parametrize(
+    "settings",
+    [{}, {"streaming": True}, {"filtered_headers": ["Gear(gangi)()"]}],
+    ids=["rows", "streaming", "columns"],
+)
+def test_format_time_column(tmp_path, group_wot, settings):
+    expected = process(
+        tmp_path / "ds2",
+        make_log(str(tmp_path)),
+        group_wot=group_wot,
+        **settings,
+    )
+    outputs = process(
+        tmp_path / "custom",
+        make_log(str(tmp_path), time_header="T"),
+        group_wot=group_wot,
+        **settings,
+    )
+
+    assert outputs.keys() == expected.keys()
+    for name, data in expected.items():
+        assert outputs[name] == data.replace(b"Time(s)", b"T", 1)
+
+
+def test_batch_output_across_time_columns(tmp_path):
+    paths = [
+        make_log(str(tmp_path), 0, time_header="T"),
+        make_log(str(tmp_path), 1),
+    ]
+    ds2 = ds2logreader.DS2LogReader(
+        output_folder=str(tmp_path / "out"),
+        log_formats=[CUSTOM_FORMAT],
+        combine_batch="arrival",
+    )
+    results = ds2.process_files(paths, max_workers=1)
+    assert [result.error for result in results] == ["", ""]
+
+    batch = ds2.finish_batch()
+    with open(batch.output_files[0], newline="") as file:
+        lines = file.read().splitlines()
+    assert lines[1].split(",")[0] == "T"
+    # times follow on across both logs, so never go backwards by much
+    times = [float(line.split(",")[0]) for line in lines[2:]]
+    assert len(times) == batch.rows_written
+    assert all(b > a - 1 for a, b in zip(times, times[1:]))
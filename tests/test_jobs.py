@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+import jobs
+
+TTL = 4 * 60 * 60
+
+
+class FakeRedis:
+    """The few sorted set and string commands RedisJobStore uses."""
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def zadd(self, key, mapping, xx=False):
+        scores = self.sets.setdefault(key, {})
+        for member, score in mapping.items():
+            if member in scores or not xx:
+                scores[member] = score
+
+    def zrem(self, key, member):
+        self.sets.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, low, high):
+        scores = self.sets.get(key, {})
+        for member in [m for m, score in scores.items() if score <= high]:
+            del scores[member]
+
+    def zcard(self, key):
+        return len(self.sets.get(key, {}))
+
+    def zscore(self, key, member):
+        return self.sets.get(key, {}).get(member)
+
+
+def redis_store():
+    store = jobs.RedisJobStore.__new__(jobs.RedisJobStore)
+    store.redis = FakeRedis()
+    store.ttl = TTL
+    return store
+
+
+def test_places_of_a_stopped_worker_are_given_back(monkeypatch):
+    store = redis_store()
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert store.reserve("a", 2)
+    store.save({"id": "a", "status": "running"})
+    assert store.reserve("b", 2)
+    assert not store.reserve("c", 2)
+
+    # only b is renewed, as if a's web worker had stopped
+    now += jobs.JOB_LEASE / 2
+    store.renew(["b"])
+    now += jobs.JOB_LEASE / 2 + 1
+    assert store.reserve("c", 2)
+    assert store.load("a")["status"] == "failed"
+
+
+def test_renew_keeps_released_jobs_out():
+    store = redis_store()
+    store.reserve("a", 2)
+    store.release("a")
+    store.renew(["a"])
+    assert store.redis.zcard(jobs.ACTIVE_KEY) == 0
+    store.save({"id": "a", "status": "done"})
+    assert store.load("a")["status"] == "done"
+
+
+def test_full_queue_refused_until_a_job_finishes():
+    job_queue = jobs.JobQueue(TTL, workers=1, queue_size=2)
+    release = threading.Event()
+    job_ids = [job_queue.submit(release.wait, 5) for _ in range(2)]
+
+    # /process answers 429 while every place is held
+    with pytest.raises(jobs.QueueFull):
+        job_queue.submit(release.wait, 5)
+
+    release.set()
+    job_queue.queue.join()
+    assert [job_queue.status(job_id)["status"] for job_id in job_ids] == [
+        "done",
+        "done",
+    ]
+    job_queue.submit(release.wait, 5)
+    job_queue.queue.join()
@@ -0,0 +1,58 @@
+import json
+import os
+
+import log_writer
+
+BACKUPS = 20
+
+
+def records(folder):
+    # messages in each file of app.log, oldest backup first
+    names = [f"app.log.{i}" for i in range(BACKUPS, 0, -1)] + ["app.log"]
+    found = []
+    for name in names:
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            with open(path) as file:
+                found.append([json.loads(line)["message"] for line in file])
+    return found
+
+
+def record(message):
+    # about 60 bytes once written
+    return "app.log", {"message": message, "pad": "-" * 30}
+
+
+def test_batch_split_across_rotations(tmp_path):
+    writer = log_writer.LogWriter(
+        str(tmp_path), max_bytes=200, backups=BACKUPS
+    )
+    writer.write([record(f"record {i}") for i in range(30)])
+
+    files = records(str(tmp_path))
+    assert [message for found in files for message in found] == [
+        f"record {i}" for i in range(30)
+    ]
+    assert all(files)
+    for path in tmp_path.glob("app.log*"):
+        assert path.stat().st_size <= 200
+
+
+def test_writers_follow_rotation_by_another(tmp_path):
+    # writers of two web worker processes on the same file
+    first = log_writer.LogWriter(str(tmp_path), max_bytes=200, backups=BACKUPS)
+    second = log_writer.LogWriter(
+        str(tmp_path), max_bytes=200, backups=BACKUPS
+    )
+    first.write([record("first 0")])
+    second.write([record("second 0")])
+
+    first.write([record(f"first {i}") for i in range(1, 6)])
+    second.write([record("second 1")])
+
+    files = records(str(tmp_path))
+    # nothing is written to a backup after it was rotated
+    assert files[-1][-1] == "second 1"
+    assert sum(len(found) for found in files) == 8
+    for path in tmp_path.glob("app.log*"):
+        assert path.stat().st_size <= 200
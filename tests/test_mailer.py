@@ -0,0 +1,85 @@
+import threading
+import time
+
+import mailer
+
+
+class FlakyTransport:
+    """Raises error for the first few sends, then sends the rest."""
+
+    def __init__(self, failures, error=ConnectionError):
+        self.failures = failures
+        self.error = error
+        self.attempts = 0
+        self.sent = threading.Event()
+
+    def send(self, email):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise self.error("unavailable")
+        self.sent.set()
+
+
+def new_email():
+    return {
+        "to": "a@example.com",
+        "subject": "Output",
+        "content": "Done",
+        "from": "ds2lv@example.com",
+        "attempts": 0,
+    }
+
+
+def test_failed_sends_retried_until_sent():
+    logs = []
+    transport = FlakyTransport(2)
+    outbox = mailer.Mailer(
+        transport,
+        backoff=0.01,
+        log=lambda message, filename=None: logs.append(message),
+    )
+    outbox.send("a@example.com", "Output", "Done", "ds2lv@example.com")
+
+    assert transport.sent.wait(5)
+    outbox.close()
+    assert transport.attempts == 3
+    assert logs[-1] == "Sent email to a@example.com"
+
+
+def test_retries_back_off_up_to_the_limit(monkeypatch):
+    now = 100.0
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    logs = []
+    outbox = mailer.Mailer(
+        FlakyTransport(10),
+        retries=4,
+        backoff=1.0,
+        max_backoff=3.0,
+        log=lambda message, filename=None: logs.append(message),
+    )
+
+    email = new_email()
+    delays = []
+    while True:
+        outbox.deliver(email)
+        if not outbox.pending:
+            break
+        due, _, email = outbox.pending.pop()
+        delays.append(due - now)
+
+    assert delays == [1.0, 2.0, 3.0, 3.0]
+    assert email["attempts"] == 5
+    assert logs[-1].startswith("Gave up on email to a@example.com")
+
+
+def test_rejected_email_not_retried():
+    logs = []
+    transport = FlakyTransport(1, error=mailer.EmailRejected)
+    outbox = mailer.Mailer(
+        transport, log=lambda message, filename=None: logs.append(message)
+    )
+
+    outbox.deliver(new_email())
+    assert outbox.pending == []
+    assert transport.attempts == 1
+    assert logs == ["Email to a@example.com rejected: unavailable"]
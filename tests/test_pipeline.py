@@ -0,0 +1,84 @@
+import concurrent.futures
+import os
+
+import pytest
+
+import pipeline
+from tests.conftest import make_log
+
+SETTINGS = {"pedal_threshold": None, "group_wot": False}
+
+
+class InlinePool:
+    """Runs each job as it is submitted, in this process."""
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    upload_pipeline = pipeline.UploadPipeline(str(tmp_path / "pipeline"), 60)
+    upload_pipeline.pool = InlinePool()
+    return upload_pipeline
+
+
+def prepared_folders(upload_pipeline, session_id):
+    folder = os.path.join(upload_pipeline.folder, session_id)
+    return os.listdir(folder) if os.path.isdir(folder) else []
+
+
+def test_take_reuses_log_with_same_settings(tmp_path, uploads):
+    log = make_log(tmp_path)
+    output_path = tmp_path / "out"
+    output_path.mkdir()
+    uploads.submit("s", log, SETTINGS)
+    assert len(prepared_folders(uploads, "s")) == 1
+
+    result = uploads.take("s", log, dict(SETTINGS), str(output_path))
+    assert result.error == ""
+    assert result.output_files
+    for output_filename in result.output_files:
+        assert os.path.dirname(output_filename) == str(output_path)
+        assert os.path.isfile(output_filename)
+    assert prepared_folders(uploads, "s") == []
+
+    # a log is only handed back once
+    assert uploads.take("s", log, SETTINGS, str(output_path)) is None
+
+
+def test_take_drops_log_with_other_settings(tmp_path, uploads):
+    log = make_log(tmp_path)
+    uploads.submit("s", log, SETTINGS)
+
+    settings = dict(SETTINGS, group_wot=True)
+    assert uploads.take("s", log, settings, str(tmp_path)) is None
+    assert prepared_folders(uploads, "s") == []
+
+
+def test_take_drops_log_changed_since(tmp_path, uploads):
+    log = make_log(tmp_path)
+    uploads.submit("s", log, SETTINGS)
+
+    stat = os.stat(log)
+    os.utime(log, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert uploads.take("s", log, SETTINGS, str(tmp_path)) is None
+    assert prepared_folders(uploads, "s") == []
+
+
+def test_submit_replaces_and_expires_prepared_logs(tmp_path, uploads):
+    log = make_log(tmp_path)
+    uploads.submit("s", log, SETTINGS)
+    uploads.submit("s", log, dict(SETTINGS, group_wot=True))
+    assert len(prepared_folders(uploads, "s")) == 1
+
+    # logs nobody collected are dropped once the ttl has passed
+    uploads.ttl = -1
+    uploads.expire()
+    assert uploads.prepared == {}
+    assert prepared_folders(uploads, "s") == []
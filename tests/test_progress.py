@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import ds2logreader
+from tests.conftest import make_log
+
+
+def make_logs(folder, count, rows=6000):
+    return [make_log(folder, i, rows=rows) for i in range(count)]
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [{}, {"engine": "bytes"}, {"streaming": True}],
+    ids=["rows", "bytes", "streaming"],
+)
+def test_progress_while_reading(tmp_path, monkeypatch, settings):
+    monkeypatch.setattr(ds2logreader, "PROGRESS_ROWS", 1000)
+    (path,) = make_logs(str(tmp_path), 1)
+    ds2 = ds2logreader.DS2LogReader(
+        output_folder=str(tmp_path / "out"), **settings
+    )
+
+    reports = []
+    ds2.process_files(
+        [path], on_progress=lambda *report: reports.append(report)
+    )
+    assert [rows for filepath, rows, bytes_read in reports] == [
+        1000 * i for i in range(1, 7)
+    ]
+    offsets = [bytes_read for filepath, rows, bytes_read in reports]
+    assert offsets == sorted(offsets)
+    assert offsets[-1] <= os.path.getsize(path)
+    assert {filepath for filepath, rows, bytes_read in reports} == {path}
+
+
+def test_progress_from_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(ds2logreader, "POOL_MIN_BYTES", 0)
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    # workers read PROGRESS_ROWS from their own import of the module
+    paths = make_logs(
+        str(tmp_path), 2, rows=ds2logreader.PROGRESS_ROWS * 2 + 1000
+    )
+    ds2 = ds2logreader.DS2LogReader(output_folder=str(tmp_path / "out"))
+
+    reports = []
+    results = ds2.process_files(
+        paths,
+        max_workers=2,
+        on_progress=lambda *report: reports.append(report),
+    )
+    assert [result.error for result in results] == ["", ""]
+    # reports come back on a queue of their own, so the last of a log may
+    # still be on its way when the batch finishes
+    assert reports
+    assert {filepath for filepath, rows, bytes_read in reports} <= set(paths)
+    assert all(
+        rows % ds2logreader.PROGRESS_ROWS == 0 for _, rows, _ in reports
+    )
@@ -0,0 +1,26 @@
+import hashlib
+import os
+
+import segment_cache
+
+
+def test_file_digest_kept_per_version(tmp_path):
+    path = tmp_path / "log.csv"
+    path.write_bytes(b"a,b\n1,2\n")
+    folder = str(tmp_path / "cache")
+
+    digest = segment_cache.SegmentCache(folder).file_digest(str(path))
+    assert digest == hashlib.sha256(b"a,b\n1,2\n").hexdigest()
+
+    # another process reads it back from the folder instead of hashing
+    other = segment_cache.SegmentCache(folder)
+    other.put = None
+    assert other.file_digest(str(path)) == digest
+
+    path.write_bytes(b"a,b\n3,4\n")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert (
+        segment_cache.SegmentCache(folder).file_digest(str(path))
+        == hashlib.sha256(b"a,b\n3,4\n").hexdigest()
+    )
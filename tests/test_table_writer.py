@@ -0,0 +1,45 @@
+import pytest
+
+import ds2logreader
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.feather  # noqa: E402
+import pyarrow.parquet  # noqa: E402
+
+READERS = {
+    "feather": pyarrow.feather.read_table,
+    "parquet": pyarrow.parquet.read_table,
+}
+
+
+@pytest.mark.parametrize("output_format", ["feather", "parquet"])
+def test_rows_written_across_batches(tmp_path, monkeypatch, output_format):
+    monkeypatch.setattr(ds2logreader, "TABLE_BATCH_ROWS", 3)
+    filename = str(tmp_path / f"out.{output_format}")
+    with ds2logreader.TableWriter(filename, output_format) as writer:
+        writer.writerow(["Title"])
+        writer.writerow(["Time(s)", "Note", "Gear"])
+        for i in range(8):
+            gear = "bad" if i == 5 else str(i % 4)
+            writer.writerow([str(i / 10), "x" if i == 0 else str(i), gear])
+
+    table = READERS[output_format](filename)
+    assert table.schema.metadata[b"title"] == b'["Title"]'
+    assert table.to_pydict() == {
+        "Time(s)": [i / 10 for i in range(8)],
+        "Note": ["x"] + [str(i) for i in range(1, 8)],
+        # numbers in the first batch, so a later word is null
+        "Gear": [0.0, 1.0, 2.0, 3.0, 0.0, None, 2.0, 3.0],
+    }
+
+
+@pytest.mark.parametrize("output_format", ["feather", "parquet"])
+def test_empty_table(tmp_path, output_format):
+    filename = str(tmp_path / f"out.{output_format}")
+    with ds2logreader.TableWriter(filename, output_format) as writer:
+        writer.writerow(["Title"])
+        writer.writerow(["Time(s)", "Gear"])
+
+    table = READERS[output_format](filename)
+    assert table.num_rows == 0
+    assert table.column_names == ["Time(s)", "Gear"]
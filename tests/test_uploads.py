@@ -0,0 +1,23 @@
+import io
+
+import pytest
+
+import uploads
+
+
+def test_late_chunk_leaves_finished_upload(tmp_path):
+    folder = str(tmp_path)
+    assert uploads.write_chunk(
+        folder, "log.csv", io.BytesIO(b"0123456789"), 0, 10
+    ) == (10, True)
+
+    with pytest.raises(uploads.UploadRejected) as rejected:
+        uploads.write_chunk(folder, "log.csv", io.BytesIO(b"56789"), 5, 10)
+    assert rejected.value.status == 409
+    assert (tmp_path / "log.csv").read_bytes() == b"0123456789"
+
+    # sent again from the start, it is replaced
+    assert uploads.write_chunk(
+        folder, "log.csv", io.BytesIO(b"abc"), 0, 3
+    ) == (3, True)
+    assert (tmp_path / "log.csv").read_bytes() == b"abc"
@@ -0,0 +1,113 @@
+import os
+import re
+import unicodedata
+
+MAX_FILE_SIZE = 157286400
+MAX_TOTAL_SIZE = 524288000
+# bytes read from the request body at a time
+READ_SIZE = 1024 * 1024
+
+# characters that are not safe in a filename
+UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|]')
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, status=413):
+        super().__init__(message)
+        self.status = status
+
+
+def sanitize_filename(filename):
+    normalized = (
+        unicodedata.normalize("NFKD", filename)
+        .encode("ascii", "ignore")
+        .decode("utf-8")
+    )
+    # a leading dot would hide the file from processing
+    return re.sub(UNSAFE_CHARS, "", normalized).lstrip(".")[:255]
+
+
+def part_path(upload_dir, filename):
+    # dot files are skipped by processing until the upload is complete
+    return os.path.join(upload_dir, f".{filename}.part")
+
+
+def received(upload_dir, filename):
+    # Bytes of the file already on disk, and if the upload is complete
+    path = os.path.join(upload_dir, filename)
+    if os.path.exists(path):
+        return os.path.getsize(path), True
+
+    part = part_path(upload_dir, filename)
+    if os.path.exists(part):
+        return os.path.getsize(part), False
+
+    return 0, False
+
+
+def folder_size(upload_dir, exclude=None):
+    # bytes of every upload and partial upload in the folder but one
+    skip = {exclude, f".{exclude}.part"} if exclude else set()
+    return sum(
+        entry.stat().st_size
+        for entry in os.scandir(upload_dir)
+        if entry.is_file() and entry.name not in skip
+    )
+
+
+def write_chunk(
+    upload_dir,
+    filename,
+    stream,
+    start,
+    total,
+    max_file_size=MAX_FILE_SIZE,
+    max_total_size=MAX_TOTAL_SIZE,
+):
+    """Write the body of one chunk of filename at byte start, and return
+    the bytes received so far and if the upload is complete.
+
+    The limits are checked against the declared total before anything is
+    written, and again as the chunk is read so a body longer than it says
+    is cut off rather than written out.
+    """
+    if total > max_file_size:
+        raise UploadRejected(f"{filename} is larger than {max_file_size}")
+
+    used = folder_size(upload_dir, exclude=filename)
+    if used + total > max_total_size:
+        raise UploadRejected(f"Uploads would be larger than {max_total_size}")
+
+    size, complete = received(upload_dir, filename)
+    if complete:
+        if start > 0:
+            # a late or repeated chunk, the finished file may already be
+            # being processed so it is left alone
+            raise UploadRejected(f"{filename} is already complete", status=409)
+        # sent again from the start, it replaces the finished file
+        os.remove(os.path.join(upload_dir, filename))
+        size = 0
+    if start > size:
+        # a chunk was lost, the client resumes from what is on disk
+        raise UploadRejected(f"{filename} has {size} bytes", status=409)
+
+    path = part_path(upload_dir, filename)
+    with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+        file.seek(start)
+        file.truncate()
+        position = start
+        while True:
+            data = stream.read(READ_SIZE)
+            if not data:
+                break
+            position += len(data)
+            if position > total or used + position > max_total_size:
+                file.truncate(start)
+                raise UploadRejected(f"{filename} is larger than {total}")
+            file.write(data)
+
+    if position < total:
+        return position, False
+
+    os.replace(path, os.path.join(upload_dir, filename))
+    return position, True